@@ -0,0 +1,142 @@
+'''
+batch_process.py preprocesses every TDT block under a directory without opening the viewer.
+
+Each block is read, decimated and its zdFF calculated in a separate worker process
+(one fresh process per block, so memory is returned to the system after every block).
+Outputs are written as compressed .npz files and a summary with per-block timings
+is written as summary.csv in the output folder.
+
+Usage:
+  python batch_process.py /path/to/tanks -o /path/to/output -j 4
+'''
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from session_cache import SessionCache, load_session
+
+# files that identify a folder as a TDT block
+TDT_EXTENSIONS = (".tsq", ".tev", ".sev")
+
+def find_blocks(root):
+  '''
+  find_blocks returns every folder under root that contains TDT files
+  '''
+  blocks = []
+  for folder, dirs, files in os.walk(root):
+    if any(f.lower().endswith(TDT_EXTENSIONS) for f in files):
+      blocks.append(folder)
+      # blocks do not contain other blocks
+      dirs[:] = []
+  return sorted(blocks)
+
+def output_path(block, root, output):
+  name = os.path.relpath(block, root).replace(os.sep, "__")
+  if name == ".":
+    name = os.path.basename(os.path.normpath(block))
+  return os.path.join(output, name + ".npz")
+
+def limit_memory(max_bytes):
+  # only on unix, the worker fails with MemoryError instead of taking down the machine
+  if max_bytes:
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+def process_block(block, out_file, cam_name="Cam1", decimate_factor=10, n_remove=5000, cache=False, float32=False):
+  '''
+  process_block runs load_session on one block and writes the result to out_file
+  float32: compute zdFF in float32 (see get_zdFF), about half the memory of the default float64
+  returns a dict with the status and the time spent in each stage
+  '''
+  summary = {"block": block, "output": out_file, "status": "ok"}
+  stages = {}
+  last = [None, time.perf_counter()]
+
+  def progress(message):
+    now = time.perf_counter()
+    if last[0] is not None:
+      stages[last[0]] = now - last[1]
+    last[0], last[1] = message, now
+
+  start = time.perf_counter()
+  try:
+    # dtype is only passed when set, so the cache keys of float64 sessions do not change
+    timestamps, photo_data = load_session(block, cam_name=cam_name, decimate_factor=decimate_factor,
+                                          n_remove=n_remove, cache=SessionCache() if cache else False,
+                                          progress=progress, **({"dtype": "float32"} if float32 else {}))
+    progress("Writing output")
+    tmp = out_file + ".tmp.npz"
+    np.savez_compressed(tmp,
+                        cam_timestamps=np.asarray(timestamps),
+                        utc_datetime=photo_data.utc_datetime,
+                        time_seconds=photo_data.time_seconds,
+                        _405=photo_data._405,
+                        _465=photo_data._465,
+                        zdFF=photo_data.zdFF)
+    os.replace(tmp, out_file)
+    progress(None)
+    summary["n_samples"] = len(photo_data)
+  except Exception as e:
+    summary["status"] = "error"
+    summary["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+  summary["total_seconds"] = time.perf_counter() - start
+  summary.update({f"{stage} (s)": seconds for stage, seconds in stages.items()})
+  return summary
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Preprocess a directory tree of TDT blocks")
+  parser.add_argument("root", help="folder to search for TDT blocks")
+  parser.add_argument("-o", "--output", default=None, help="output folder, defaults to root/processed")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+  parser.add_argument("--max-memory-gb", type=float, default=None, help="address space limit per worker")
+  parser.add_argument("--cam-name", default="Cam1")
+  parser.add_argument("--decimate-factor", type=int, default=10)
+  parser.add_argument("--n-remove", type=int, default=5000)
+  parser.add_argument("--float32", action="store_true", help="compute zdFF in float32 to reduce memory")
+  parser.add_argument("--cache", action="store_true", help="also fill the viewer cache so the player opens these blocks instantly")
+  parser.add_argument("--force", action="store_true", help="process blocks that already have an output")
+  args = parser.parse_args(argv)
+
+  output = args.output or os.path.join(args.root, "processed")
+  os.makedirs(output, exist_ok=True)
+  blocks = [block for block in find_blocks(args.root) if os.path.abspath(block) != os.path.abspath(output)]
+  todo = []
+  summaries = []
+  for block in blocks:
+    out_file = output_path(block, args.root, output)
+    if os.path.exists(out_file) and not args.force:
+      summaries.append({"block": block, "output": out_file, "status": "skipped"})
+    else:
+      todo.append((block, out_file))
+  print(f"Found {len(blocks)} blocks, {len(todo)} to process")
+
+  max_bytes = int(args.max_memory_gb * 1024**3) if args.max_memory_gb else None
+  # fresh processes (spawn) are required to recycle a worker after each block
+  with ProcessPoolExecutor(max_workers=args.jobs, max_tasks_per_child=1,
+                           mp_context=multiprocessing.get_context("spawn"),
+                           initializer=limit_memory, initargs=(max_bytes,)) as pool:
+    futures = {pool.submit(process_block, block, out_file, args.cam_name, args.decimate_factor,
+                           args.n_remove, args.cache, args.float32): (block, out_file) for block, out_file in todo}
+    for future in as_completed(futures):
+      try:
+        summary = future.result()
+      except Exception as e:
+        # the worker died (e.g. killed when running out of memory)
+        block, out_file = futures[future]
+        summary = {"block": block, "output": out_file, "status": "error", "error": repr(e), "total_seconds": float("nan")}
+      summaries.append(summary)
+      print(f"[{summary['status']}] {summary['block']} ({summary['total_seconds']:.1f} s)")
+
+  summary_file = os.path.join(output, "summary.csv")
+  pd.DataFrame(summaries).to_csv(summary_file, index=False)
+  print(f"Summary written to {summary_file}")
+  return 0 if all(s["status"] != "error" for s in summaries) else 1
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,599 @@
+'''
+benchmark.py times the photometry pipeline on synthetic data, the fast implementations
+against the reference ones they replaced (the equivalence tests are in test_*.py, run with pytest).
+
+The suite (run_suite) writes synthetic TDT blocks of increasing duration and measures the
+time and peak memory of every stage (reading and decimating, smoothing, airPLS, get_zdFF and
+the per-frame update of the player), fits how each stage scales with the recording length and
+saves the results as JSON, so two releases can be compared with --compare.
+
+Usage:
+  python benchmark.py                      # micro-benchmarks and the suite
+  python benchmark.py --suite-only --minutes 10 30 60 -o results.json
+  python benchmark.py --suite-only --compare results.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import scipy.signal
+from scipy.sparse import csc_matrix, eye, diags
+from scipy.sparse.linalg import spsolve
+from photometry_functions import *
+from time_index import TimeIndex
+from frame_alignment import FrameAlignment
+from decimation import decimate_chunked
+from raw_block import RawBlock
+
+
+def reference_WhittakerSmooth(x, w, lambda_, differences=1):
+  '''
+  Sparse spsolve implementation of WhittakerSmooth, kept to time and test the banded solver against
+  '''
+  m = len(x)
+  E = eye(m, format='csc')
+  for i in range(differences):
+    E = E[1:] - E[:-1]
+  W = diags(w, 0, shape=(m, m))
+  A = csc_matrix(W + (lambda_ * E.T @ E))
+  return spsolve(A, w * x)
+
+
+def reference_smooth_signal(x, window_len=10, window='flat'):
+  '''
+  Direct np.convolve implementation of smooth_signal, kept to time and test the O(n) kernels against
+  '''
+  s = np.r_[x[window_len-1:0:-1], x, x[-2:-window_len-1:-1]]
+  w = np.ones(window_len, 'd') if window == 'flat' else getattr(np, window)(window_len)
+  y = np.convolve(w / w.sum(), s, mode='valid')
+  return y[(int(window_len/2)-1):-int(window_len/2)]
+
+
+def synthetic_signal(n, fs=101.7, seed=0):
+  '''
+  Slow exponential drift plus transients and noise, roughly what a decimated TDT channel looks like
+  '''
+  rng = np.random.default_rng(seed)
+  t = np.arange(n) / fs
+  drift = 50 + 10 * np.exp(-t / (t[-1] / 3 + 1))
+  transients = np.zeros(n)
+  onsets = rng.integers(0, n, size=max(1, n // 2000))
+  transients[onsets] = rng.uniform(1, 5, size=onsets.size)
+  transients = np.convolve(transients, np.exp(-np.arange(int(fs * 2)) / fs * 3))[:n]
+  return drift + transients + rng.normal(0, 0.3, n)
+
+
+def synthetic_pair(n, fs=1017.25, seed=0):
+  '''
+  isosbestic and calcium-dependent full-rate channels: both share photobleaching and motion
+  artifacts, only the calcium-dependent one has transients
+  '''
+  rng = np.random.default_rng(seed + 1000)
+  t = np.arange(n) / fs
+  motion = np.convolve(rng.normal(0, 0.05, n), np.ones(int(fs)) / np.sqrt(fs), mode="same")
+  reference = 40 + 5 * np.exp(-t / (t[-1] / 3 + 1)) + motion + rng.normal(0, 0.3, n)
+  signal = synthetic_signal(n, fs=fs, seed=seed) + 1.5 * motion
+  return reference.astype(np.float32), signal.astype(np.float32)
+
+
+def write_block(folder, minutes, fs=1017.25, seed=0):
+  '''
+  writes a synthetic block with 405A and 465A .sev streams, returns the number of samples per stream
+  '''
+  n = int(minutes * 60 * fs)
+  reference, signal = synthetic_pair(n, fs=fs, seed=seed)
+  name = os.path.basename(os.path.normpath(folder))
+  write_sev(os.path.join(folder, f"{name}_405A_ch1.sev"), "405A", reference)
+  write_sev(os.path.join(folder, f"{name}_465A_ch1.sev"), "465A", signal)
+  return n
+
+
+def write_sev(path, name, data, rate=4, decimate=96):
+  '''
+  writes data as a single channel float32 .sev file, fs = 2**(rate - 12) * 25e6 / decimate (1017.25 Hz by default)
+  '''
+  import struct
+  data = np.asarray(data, dtype="<f4")
+  header = struct.pack("<Q3sB4sHHHHBBH", data.nbytes + 40, b"SEV", 3, name.encode(), 1, 1, 4, 0, 0, decimate, rate)
+  with open(path, "wb") as f:
+    f.write(header.ljust(40, b"\0"))
+    data.tofile(f)
+
+
+def peak_memory(fun, *args, **kwargs):
+  '''
+  returns the peak memory in bytes allocated while running fun (numpy allocations included)
+  '''
+  tracemalloc.start()
+  try:
+    fun(*args, **kwargs)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def timeit(fun, *args, repeat=1, **kwargs):
+  best = np.inf
+  for _ in range(repeat):
+    start = time.perf_counter()
+    out = fun(*args, **kwargs)
+    best = min(best, time.perf_counter() - start)
+  return best, out
+
+
+def bench_whittaker(sizes=(10**5, 10**6, 10**7), lambd=5e4):
+  print(f"{'n':>10} {'spsolve (s)':>12} {'banded (s)':>12} {'airPLS (s)':>12}")
+  for n in sizes:
+    x = synthetic_signal(n)
+    w = np.ones(n)
+    ref = np.nan
+    if n <= 10**6:
+      ref, _ = timeit(reference_WhittakerSmooth, x, w, lambd)
+    fast, _ = timeit(WhittakerSmooth, x, w, lambd, repeat=3)
+    air, _ = timeit(airPLS, x, lambda_=lambd, itermax=50)
+    print(f"{n:>10} {ref:>12.3f} {fast:>12.3f} {air:>12.3f}")
+
+
+def bench_time_index(sizes=(10**4, 10**5, 10**6, 10**7), fs=101.7, lookups=1000):
+  '''
+  per-frame lookup cost, should not grow with the recording length
+  '''
+  print(f"{'n':>10} {'argmin (us)':>12} {'uniform (us)':>13} {'searchsorted (us)':>18}")
+  for n in sizes:
+    times = np.arange(n) / fs
+    queries = np.random.default_rng(3).uniform(0, n / fs, lookups)
+    uniform = TimeIndex(times)
+    binary = TimeIndex(times)
+    binary.dt = None
+    argmin, _ = timeit(lambda: [np.argmin(np.abs(q - times)) for q in queries[:10]])
+    fast, _ = timeit(lambda: [uniform.nearest(q) for q in queries], repeat=3)
+    bsearch, _ = timeit(lambda: [binary.nearest(q) for q in queries], repeat=3)
+    print(f"{n:>10} {argmin / 10 * 1e6:>12.1f} {fast / lookups * 1e6:>13.1f} {bsearch / lookups * 1e6:>18.1f}")
+
+
+def bench_decimation(n=10**7, q=10, block_size=2**20):
+  '''
+  decimation of a float32 stream stored on disk: reading it all and calling scipy (what
+  get_tdt_data does after tdt.read_block) against decimate_chunked on a memory-map
+  '''
+  import tempfile
+  x = synthetic_signal(n).astype(np.float32)
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "stream.f32")
+    x.tofile(path)
+    del x
+    stream = np.memmap(path, dtype=np.float32, mode="r")
+    read_all = lambda: scipy.signal.decimate(np.array(stream), q, ftype="fir")
+    chunked = lambda: decimate_chunked(stream, q, block_size=block_size)
+    print(f"{'decimation':>12} {'time (s)':>10} {'peak (MB)':>10}")
+    for name, fun in (("read + scipy", read_all), ("chunked", chunked)):
+      seconds, _ = timeit(fun)
+      print(f"{name:>12} {seconds:>10.3f} {peak_memory(fun) / 1e6:>10.1f}")
+    del stream
+
+def bench_raw_block(hours=(1, 4), fs=1017.25):
+  '''
+  time to open a block with memory-mapped streams and to read one 10 s plot window
+  '''
+  import tempfile
+  print(f"{'hours':>6} {'size (MB)':>10} {'open (ms)':>10} {'window (ms)':>12}")
+  for h in hours:
+    n = int(h * 3600 * fs)
+    with tempfile.TemporaryDirectory() as folder:
+      for name in ("405A", "465A"):
+        write_sev(os.path.join(folder, f"block_{name}_ch1.sev"), name, np.zeros(n, dtype=np.float32))
+      size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+      opened, block = timeit(lambda: RawBlock(folder), repeat=3)
+      stream = block.stream("465A").data
+      window, _ = timeit(lambda: np.array(stream[n // 2:n // 2 + int(10 * fs)]), repeat=3)
+      print(f"{h:>6} {size / 1e6:>10.0f} {opened * 1e3:>10.2f} {window * 1e3:>12.3f}")
+      del stream, block
+
+def bench_airPLS_segmented(sizes=(10**5, 10**6, 4 * 10**6), window=2**16, lambd=5e4, itermax=50):
+  '''
+  segmented airPLS against the global fit: error relative to the signal std, time and peak memory
+  '''
+  import contextlib, io
+  print(f"{'n':>10} {'global (s)':>11} {'segmented (s)':>14} {'memory (MB)':>12} {'max error / std':>16}")
+  for n in sizes:
+    x = smooth_signal(synthetic_signal(n), 10)
+    with contextlib.redirect_stdout(io.StringIO()):
+      segmented, z = timeit(airPLS_segmented, x, lambd, 1, itermax, window=window)
+      memory = peak_memory(airPLS_segmented, x, lambd, 1, itermax, window=window)
+      if n <= 10**6:
+        full, reference = timeit(airPLS, x, lambd, 1, itermax)
+        error = f"{np.abs(z - reference).max() / np.std(x):>16.2e}"
+      else:
+        full, error = float("nan"), f"{'-':>16}"
+    print(f"{n:>10} {full:>11.2f} {segmented:>14.2f} {memory / 1e6:>12.1f} {error}")
+
+def bench_fast_align(sizes=(10**4, 10**6), seed=1):
+  '''
+  fit_positive_slope against sklearn's Lasso
+  '''
+  from sklearn.linear_model import Lasso
+  rng = np.random.default_rng(seed)
+  print(f"{'n':>10} {'Lasso (ms)':>11} {'closed form (ms)':>17} {'slope error':>12}")
+  for n in sizes:
+    x = rng.standard_normal(n)
+    y = 0.8 * x + rng.standard_normal(n)
+    lin = Lasso(alpha=0.0001, precompute=True, max_iter=1000, positive=True, random_state=9999, selection='random')
+    lasso, _ = timeit(lin.fit, x.reshape(n, 1), y.reshape(n, 1), repeat=3)
+    fast, (slope, intercept) = timeit(fit_positive_slope, x, y, repeat=3)
+    print(f"{n:>10} {lasso * 1e3:>11.2f} {fast * 1e3:>17.2f} {abs(slope - lin.coef_[0]):>12.1e}")
+
+def bench_smoothing(n=10**6, windows=(10, 101, 1017, 10170)):
+  print(f"{'window':>7} {'convolve (ms)':>14} {'flat (ms)':>10} {'hanning (ms)':>13}")
+  x = synthetic_signal(n)
+  for window_len in windows:
+    direct, _ = timeit(reference_smooth_signal, x, window_len) if window_len <= 1017 else (float("nan"), None)
+    flat, _ = timeit(smooth_signal, x, window_len, repeat=3)
+    hanning, _ = timeit(smooth_signal, x, window_len, 'hanning', repeat=3)
+    print(f"{window_len:>7} {direct * 1e3:>14.1f} {flat * 1e3:>10.1f} {hanning * 1e3:>13.1f}")
+
+def bench_frame_alignment(hours=2, fps=30, fs=101.7, seed=0):
+  '''
+  cost of one FrameAlignment lookup over jittered frame onsets
+  '''
+  rng = np.random.default_rng(seed)
+  n_frames = int(hours * 3600 * fps)
+  onsets = 0.25 + np.cumsum(rng.uniform(0.9, 1.1, n_frames) / fps)
+  photo_times = np.arange(int((onsets[-1] + 1) * fs)) / fs
+  alignment = FrameAlignment(onsets, photo_times)
+  positions = rng.uniform(-1000, (onsets[-1] - onsets[0]) * 1000 + 1000, 10000)
+  lookup, _ = timeit(lambda: [alignment.lookup(p) for p in positions])
+  print(f"FrameAlignment ({n_frames} frames): {lookup / len(positions) * 1e6:.2f} us per lookup")
+
+def bench_peth(n_events=(100, 1000, 10000), n=10**6, fs=101.7, before=2.0, after=5.0):
+  '''
+  get_peth against a per-trial loop, including events at both ends of the recording
+  '''
+  from peth import get_peth
+  time_seconds = np.arange(n) / fs
+  photo_data = {"time_seconds": time_seconds, "zdFF": synthetic_signal(n, fs=fs).astype(np.float32)}
+  rng = np.random.default_rng(0)
+  print(f"{'events':>7} {'loop (ms)':>10} {'strided (ms)':>13}")
+  for n_events in n_events:
+    events = np.concatenate([[0.5, time_seconds[-1] - 1], rng.uniform(0, time_seconds[-1], n_events - 2)])
+
+    def loop():
+      trials = []
+      for t in events:
+        center = np.argmin(np.abs(time_seconds - t))
+        index = np.arange(center - int(round(before * fs)), center + int(round(after * fs)) + 1)
+        trial = np.full(len(index), np.nan, dtype=np.float32)
+        valid = (index >= 0) & (index < n)
+        trial[valid] = photo_data["zdFF"][index[valid]]
+        trials.append(trial)
+      return np.array(trials)
+    looped, expected = timeit(loop) if n_events <= 1000 else (float("nan"), None)
+    strided, peth = timeit(get_peth, photo_data, events, before, after, repeat=3)
+    if expected is not None:
+      assert np.array_equal(peth.trials, expected, equal_nan=True)
+    print(f"{n_events:>7} {looped * 1e3:>10.1f} {strided * 1e3:>13.1f}")
+
+def bench_online_zdFF(minutes=20, fs=1017.25, q=10, block_seconds=(0.1, 1.0, 5.0)):
+  '''
+  replays a synthetic session through OnlineZdFF and compares it with the batch zdFF
+  '''
+  from get_tdt_data import PhotometryData
+  from online_zdFF import compare_with_batch
+  reference, signal = synthetic_pair(int(minutes * 60 * fs), fs=fs)
+  reference = scipy.signal.decimate(reference, q, ftype="fir")
+  signal = scipy.signal.decimate(signal, q, ftype="fir")
+  print(f"{'block (s)':>10} {'robust':>7} {'correlation':>12} {'mean (ms)':>10} {'p99 (ms)':>9} {'max (ms)':>9}")
+  for seconds in block_seconds:
+    for robust in (True, False):
+      photo_data = PhotometryData(reference, signal, q / fs, None, None)
+      result = quiet(compare_with_batch)(photo_data, n_remove=500, block_seconds=seconds, robust=robust)
+      print(f"{seconds:>10} {str(robust):>7} {result['correlation']:>12.3f} {result['block_mean_ms']:>10.2f} "
+            f"{result['block_p99_ms']:>9.2f} {result['block_max_ms']:>9.2f}")
+
+
+def bench_timebase(hours=(1, 8), fs=1017.25, q=10):
+  '''
+  Timebase against pd.date_range, and searchsorted without materializing the times
+  '''
+  import datetime
+  import pandas as pd
+  from timebase import Timebase
+  start = datetime.datetime(2022, 4, 15, 5, 20)
+  print(f"{'hours':>6} {'date_range (ms)':>16} {'datetimes (ms)':>15} {'searchsorted (us)':>18} {'peak (MB)':>10}")
+  for h in hours:
+    n = int(h * 3600 * fs / q)
+    timebase = Timebase(n, fs, q, start=start)
+    date_range, expected = timeit(lambda: pd.date_range(start, periods=n, freq=pd.Timedelta(q / fs, "s")).values)
+    datetimes, times = timeit(timebase.datetimes)
+    # pd.date_range rounds the frequency to whole nanoseconds, the timebase keeps the exact period
+    assert np.abs(times - expected).max() <= np.timedelta64(n, "ns")
+    queries = np.random.default_rng(0).uniform(0, h * 3600, 1000)
+    search, found = timeit(timebase.searchsorted, queries, repeat=3)
+    assert np.array_equal(found, np.searchsorted(timebase.seconds(), queries))
+    peak = peak_memory(timebase.searchsorted, queries)
+    print(f"{h:>6} {date_range * 1e3:>16.1f} {datetimes * 1e3:>15.1f} {search / len(queries) * 1e6:>18.3f} {peak / 1e6:>10.3f}")
+
+
+def bench_float32(minutes=120, fs=1017.25, q=10, chunk_size=2**20):
+  '''
+  peak memory of every stage of the pipeline with get_zdFF in float64 and in float32,
+  and the difference between the two zdFF
+  '''
+  import tempfile
+  from instrumentation import start_trace, stop_trace
+  from get_tdt_data import get_photometry_data, calculate_session_zdFF
+  import sklearn.linear_model
+  peaks = {}
+  zdFF = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    folder = os.path.join(tmp, "block")
+    os.makedirs(folder)
+    write_block(folder, minutes, fs=fs)
+    for dtype in ("float64", "float32"):
+      block = RawBlock(folder)
+      start_trace()
+      tracemalloc.start()
+      try:
+        photo_data = get_photometry_data(block, decimate_factor=q, chunk_size=chunk_size)
+        quiet(calculate_session_zdFF)(photo_data, n_remove=int(5 * photo_data.fs), dtype=dtype)
+      finally:
+        tracemalloc.stop()
+        events = stop_trace()
+      peaks[dtype] = {e["name"]: e["args"]["peak_bytes"] for e in events if e["ph"] == "X"}
+      zdFF[dtype] = photo_data.zdFF
+      del block
+  error = zdFF["float32"].astype(np.float64) - zdFF["float64"]
+  print(f"{minutes} minutes, {len(error)} samples: zdFF max abs difference {np.abs(error).max():.2e}, "
+        f"RMS {np.sqrt(np.mean(error ** 2)):.2e}, zdFF std {zdFF['float64'].std():.2f}")
+  print(f"{'stage':>10} {'float64 (MB)':>13} {'float32 (MB)':>13} {'ratio':>6}")
+  for name, peak in peaks["float64"].items():
+    print(f"{name:>10} {peak / 1e6:>13.1f} {peaks['float32'][name] / 1e6:>13.1f} {peaks['float32'][name] / peak:>6.2f}")
+
+
+def bench_airPLS_sweep(n=10**6, lambdas=np.logspace(3, 7, 13), itermax=50):
+  '''
+  sweep over lambda_ from scratch and warm-started, iterations saved and distance to the cold fits
+  '''
+  x = synthetic_signal(n)
+  # offset removed so airPLS needs several iterations, as on baseline-subtracted recordings
+  x = x - np.median(x) + 0.5
+  for n_jobs in (1, 4):
+    seconds, result = timeit(quiet(compare_warm_start), x, lambdas, 1, itermax, n_jobs)
+    print(f"sweep of {len(lambdas)} lambdas (n_jobs={n_jobs}, {seconds:.2f} s for both): "
+          f"{result['cold_iterations'].sum()} cold iterations, {result['iterations_saved']} saved by the warm start, "
+          f"max distance to the cold fits {result['distance'].max():.3f} std")
+
+
+# cold import budget of player.py (Qt and pyqtgraph included), the processing modules are deferred
+STARTUP_BUDGET_SECONDS = 1.5
+# what player.py imports at startup and what it only imports when a session is opened
+STARTUP_MODULES = ("player", "instrumentation", "time_index", "frame_alignment", "scrolling_trace", "lod_pyramid")
+DEFERRED_MODULES = ("session_cache", "sklearn.linear_model")
+
+def import_time(module, top=5):
+  '''
+  cold import time of module in a fresh interpreter (python -X importtime)
+  returns {"seconds", "heaviest": [(module, self seconds), ...]} or {"error"} if it cannot be imported
+  '''
+  import subprocess
+  proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                        text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+  if proc.returncode:
+    return {"error": proc.stderr.strip().splitlines()[-1]}
+  rows = []
+  for line in proc.stderr.splitlines():
+    if not line.startswith("import time:") or "self [us]" in line:
+      continue
+    own, cumulative, name = line[len("import time:"):].split("|")
+    rows.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6, len(name) - len(name.lstrip())))
+  # top level imports have the smallest indentation
+  indent = min(row[3] for row in rows)
+  total = sum(cumulative for _, _, cumulative, level in rows if level == indent)
+  heaviest = sorted(((name, own) for name, own, _, _ in rows), key=lambda row: -row[1])[:top]
+  return {"seconds": total, "heaviest": heaviest}
+
+def bench_imports(budget=STARTUP_BUDGET_SECONDS):
+  '''
+  import-time report, player.py should start within budget seconds
+  returns {module: import_time(module)}
+  '''
+  report = {}
+  print(f"{'module':>22} {'import (s)':>11}  heaviest")
+  for module in STARTUP_MODULES + DEFERRED_MODULES:
+    result = report[module] = import_time(module)
+    if "error" in result:
+      print(f"{module:>22} {'-':>11}  {result['error']}")
+      continue
+    heaviest = ", ".join(f"{name} {own * 1e3:.0f} ms" for name, own in result["heaviest"][:3])
+    print(f"{module:>22} {result['seconds']:>11.3f}  {heaviest}")
+  player = report["player"]
+  if "seconds" in player:
+    status = "within" if player["seconds"] <= budget else "OVER"
+    print(f"player.py imports in {player['seconds']:.2f} s, {status} the {budget:.2f} s budget")
+  return report
+
+
+def measure(fun, *args, repeat=1, **kwargs):
+  '''
+  returns (best time in seconds, peak traced memory in bytes, output of fun)
+  the memory is measured on a separate run, tracing slows allocations down
+  '''
+  seconds, out = timeit(fun, *args, repeat=repeat, **kwargs)
+  return seconds, peak_memory(fun, *args, **kwargs), out
+
+def quiet(fun):
+  '''
+  wraps fun so the messages it prints or logs (e.g. airPLS convergence warnings) are discarded
+  '''
+  import io
+  import logging
+  import contextlib
+
+  def wrapped(*args, **kwargs):
+    logger = logging.getLogger("tdt_photo_viewer")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+      with contextlib.redirect_stdout(io.StringIO()):
+        return fun(*args, **kwargs)
+    finally:
+      logger.setLevel(level)
+  return wrapped
+
+def frame_updates(photo_data, fps=30, seconds=60, seed=0):
+  '''
+  replays what Player.onNewData does for every video frame (alignment lookup and live trace update)
+  returns the time of each update in seconds
+  '''
+  from scrolling_trace import ScrollingTrace
+  time_seconds = photo_data.time_seconds
+  duration = time_seconds[-1]
+  cam_timestamps = np.arange(0, duration, 1 / fps)
+  alignment = FrameAlignment(cam_timestamps, time_seconds)
+  trace = ScrollingTrace(time_seconds, photo_data.zdFF, 5 * 1000)
+  start = np.random.default_rng(seed).uniform(0, max(duration - seconds, 0)) * 1000
+  updates = []
+  for position in start + np.arange(int(seconds * fps)) * 1000 / fps:
+    t0 = time.perf_counter()
+    frame, current_second, sample = alignment.lookup(position)
+    x, y = trace.update(sample)
+    trace.y_range()
+    updates.append(time.perf_counter() - t0)
+  return np.array(updates)
+
+def run_suite(minutes=(5, 15, 30, 60), fs=1017.25, decimate_factor=10, chunk_size=2**20):
+  '''
+  times every stage of the pipeline on synthetic blocks of each duration
+  returns a list of records {stage, minutes, n_samples, seconds, peak_bytes}
+  '''
+  import tempfile
+  from get_tdt_data import get_photometry_data, calculate_session_zdFF
+  # the Lasso fit imports scikit-learn on its first call, keep that out of the first duration
+  import sklearn.linear_model
+  records = []
+
+  def record(stage, minutes, n, seconds, peak, **extra):
+    records.append(dict(stage=stage, minutes=minutes, n_samples=n, seconds=seconds, peak_bytes=peak, **extra))
+    print(f"{stage:>16} {minutes:>8} {n:>10} {seconds:>10.3f} {peak / 1e6:>10.1f}")
+
+  print(f"{'stage':>16} {'minutes':>8} {'samples':>10} {'time (s)':>10} {'peak (MB)':>10}")
+  for duration in minutes:
+    with tempfile.TemporaryDirectory() as tmp:
+      folder = os.path.join(tmp, "block")
+      os.makedirs(folder)
+      n_raw = write_block(folder, duration, fs=fs)
+      block = RawBlock(folder)
+      read = lambda chunk: get_photometry_data(block, decimate_factor=decimate_factor, chunk_size=chunk)
+      seconds, peak, photo_data = measure(read, chunk_size)
+      record("read_decimate", duration, n_raw, seconds, peak)
+      seconds, peak, _ = measure(read, None)
+      record("read_scipy", duration, n_raw, seconds, peak)
+      del block
+    n = len(photo_data)
+    one_second = int(photo_data.fs)
+    reference = photo_data._405.astype(np.float64)
+    seconds, peak, smoothed = measure(smooth_signal, reference, one_second, repeat=3)
+    record("smooth_signal", duration, n, seconds, peak)
+    seconds, peak, _ = measure(quiet(airPLS), smoothed, 5e4, 1, 50)
+    record("airPLS", duration, n, seconds, peak)
+    seconds, peak, _ = measure(quiet(get_zdFF), reference, photo_data._465.astype(np.float64), one_second, 1)
+    record("get_zdFF", duration, n, seconds, peak)
+    seconds, peak, photo_data = measure(quiet(calculate_session_zdFF), photo_data, n_remove=int(5 * photo_data.fs))
+    record("calculate_zdFF", duration, n, seconds, peak)
+    updates = frame_updates(photo_data)
+    record("frame_update", duration, n, float(np.mean(updates)), peak_memory(frame_updates, photo_data, seconds=5),
+           p99_seconds=float(np.percentile(updates, 99)))
+  return records
+
+def scaling_exponents(records):
+  '''
+  fits seconds ~ n_samples ** k for every stage, k close to 1 means linear scaling
+  '''
+  exponents = {}
+  for stage in dict.fromkeys(r["stage"] for r in records):
+    points = [(r["n_samples"], r["seconds"]) for r in records if r["stage"] == stage and r["seconds"] > 0]
+    if len(points) > 1:
+      n, seconds = np.log(np.array(points)).T
+      exponents[stage] = float(np.polyfit(n, seconds, 1)[0])
+  return exponents
+
+def environment():
+  import subprocess
+  import scipy
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    commit = None
+  return {
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "commit": commit,
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "scipy": scipy.__version__,
+    "platform": platform.platform(),
+    "cpu_count": os.cpu_count(),
+  }
+
+def compare(results, baseline):
+  '''
+  prints the time and memory of results relative to a previous results file
+  '''
+  previous = {(r["stage"], r["n_samples"]): r for r in baseline["results"]}
+  print(f"comparing with {baseline['environment'].get('commit')} ({baseline['environment'].get('date')})")
+  print(f"{'stage':>16} {'samples':>10} {'time ratio':>11} {'memory ratio':>13}")
+  for r in results:
+    old = previous.get((r["stage"], r["n_samples"]))
+    if old is None:
+      continue
+    time_ratio = r["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+    memory_ratio = r["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] else float("nan")
+    print(f"{r['stage']:>16} {r['n_samples']:>10} {time_ratio:>11.2f} {memory_ratio:>13.2f}")
+
+def run_benchmarks():
+  bench_whittaker()
+  bench_time_index()
+  bench_frame_alignment()
+  bench_decimation()
+  bench_raw_block()
+  bench_airPLS_segmented()
+  bench_fast_align()
+  bench_smoothing()
+  bench_peth()
+  bench_online_zdFF()
+  bench_timebase()
+  bench_float32()
+  bench_airPLS_sweep()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the photometry pipeline on synthetic data")
+  parser.add_argument("--suite-only", action="store_true", help="skip the micro-benchmarks")
+  parser.add_argument("--minutes", type=float, nargs="+", default=[5, 15, 30, 60], help="recording durations of the suite")
+  parser.add_argument("-o", "--output", default=None, help="write the suite results to this JSON file")
+  parser.add_argument("--compare", default=None, help="JSON file from a previous run to compare against")
+  args = parser.parse_args(argv)
+
+  if not args.suite_only:
+    run_benchmarks()
+  records = run_suite(minutes=args.minutes)
+  exponents = scaling_exponents(records)
+  print("scaling with the recording length (time ~ n ** k): " +
+        ", ".join(f"{stage} {k:.2f}" for stage, k in exponents.items()))
+  imports = bench_imports()
+  results = {"environment": environment(), "results": records, "scaling": exponents, "imports": imports}
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+  if args.compare:
+    with open(args.compare) as f:
+      compare(records, json.load(f))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
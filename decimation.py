@@ -0,0 +1,107 @@
+'''
+decimation.py decimates long streams in fixed-size blocks.
+
+FIRDecimator reproduces scipy.signal.decimate(x, q, ftype="fir") (the zero phase,
+hamming-windowed FIR used by get_tdt_data) but takes the signal one block at a time and
+carries the last samples of each block over to the next one, so peak memory depends on
+the block size and not on the length of the recording. The input blocks can come from
+any array-like, e.g. a memory-mapped .sev file.
+'''
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+class FIRDecimator:
+  '''
+  FIRDecimator decimates a stream by an integer factor q, block by block
+  q: decimation factor
+  dtype: dtype of the output (scipy.signal.decimate keeps float32 inputs as float32)
+  '''
+  def __init__(self, q, dtype=np.float64):
+    self.q = int(q)
+    self.dtype = np.dtype(dtype)
+    # same filter as scipy.signal.decimate(..., ftype="fir")
+    self.half_len = 10 * self.q
+    self.b = firwin(2 * self.half_len + 1, 1. / self.q, window='hamming').astype(self.dtype)
+    self.reset()
+
+  def reset(self):
+    self.n_in = 0
+    self.n_out = 0
+    # the filter is centered on each output sample, the signal is zero before its start
+    self.buffer = np.zeros(self.half_len, dtype=self.dtype)
+
+  def _filter(self, flush=False):
+    '''
+    computes every output whose filter window is inside the buffer
+    the buffer always starts 10q samples before the next output sample
+    '''
+    width = 2 * self.half_len
+    available = (len(self.buffer) - width - 1) // self.q + 1
+    if flush:
+      # outputs up to ceil(n_in / q), the buffer was padded with zeros
+      available = min(available, -(-self.n_in // self.q) - self.n_out)
+    if available <= 0:
+      return np.empty(0, dtype=self.dtype)
+    needed = (available - 1) * self.q + width + 1
+    # full convolution downsampled by q, output k is at index k + 2 * 10
+    y = upfirdn(self.b, self.buffer[:needed], up=1, down=self.q)
+    out = y[2 * self.half_len // self.q:][:available].astype(self.dtype, copy=False)
+    self.buffer = self.buffer[available * self.q:]
+    self.n_out += available
+    return out
+
+  def process(self, block):
+    '''
+    feed the next block of the stream, returns the decimated samples now available
+    '''
+    block = np.asarray(block, dtype=self.dtype)
+    self.n_in += len(block)
+    self.buffer = np.concatenate([self.buffer, block])
+    return self._filter()
+
+  def flush(self):
+    '''
+    returns the last decimated samples once the whole stream was fed
+    '''
+    self.buffer = np.concatenate([self.buffer, np.zeros(self.half_len + self.q, dtype=self.dtype)])
+    out = self._filter(flush=True)
+    self.reset()
+    return out
+
+def iter_blocks(x, block_size, length=None):
+  '''
+  iter_blocks yields consecutive views of x (e.g. a numpy.memmap) of block_size samples
+  length: only the first length samples of x are used
+  '''
+  length = len(x) if length is None else min(length, len(x))
+  for start in range(0, length, block_size):
+    yield x[start:min(start + block_size, length)]
+
+def decimate_chunked(x, q, block_size=2**20, dtype=None, length=None):
+  '''
+  decimate_chunked matches scipy.signal.decimate(x, q, ftype="fir") within floating point tolerance
+  x: 1D array-like (only block_size samples are read at a time) or an iterable of blocks
+  q: decimation factor
+  dtype: output dtype, defaults to float32 for float32 inputs and float64 otherwise
+  length: decimate only the first length samples of x (same as passing x[:length])
+  '''
+  if not (hasattr(x, "__len__") and hasattr(x, "dtype")):
+    decimator = FIRDecimator(q, dtype=dtype or np.float64)
+    out = [decimator.process(block) for block in x]
+    out.append(decimator.flush())
+    return np.concatenate(out)
+  if dtype is None:
+    dtype = np.float32 if x.dtype == np.float32 else np.float64
+  decimator = FIRDecimator(q, dtype=dtype)
+  length = len(x) if length is None else min(length, len(x))
+  # the output size is known, write the blocks in place
+  out = np.empty(-(-length // q), dtype=dtype)
+  filled = 0
+  for block in iter_blocks(x, block_size, length):
+    y = decimator.process(block)
+    out[filled:filled + len(y)] = y
+    filled += len(y)
+  y = decimator.flush()
+  out[filled:filled + len(y)] = y
+  return out
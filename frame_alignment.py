@@ -0,0 +1,71 @@
+'''
+frame_alignment.py maps the video position to camera frames and photometry samples.
+
+FrameAlignment is built once per session from the camera epoc onsets (get_cam_timestamps)
+and the photometry time vector. It stores, for every frame, the photometry samples recorded
+while that frame was exposed, so the player only needs the playback position in ms to know
+which frame is shown and which samples to plot, at any playback rate and after any seek,
+without counting the frames that were decoded.
+'''
+
+import numpy as np
+from time_index import TimeIndex
+
+class FrameAlignment:
+  '''
+  FrameAlignment is a lookup table from video position to frame and photometry samples
+  cam_timestamps: onset of each camera frame in seconds from the start of the block
+  photo_times: time of each photometry sample in seconds from the start of the block
+  video_start: block time shown at video position 0, defaults to the first frame onset
+  Without camera frames (e.g. an empty camera file) video_start defaults to 0 and lookup
+  maps the video position to block time directly, always with frame 0
+  '''
+  def __init__(self, cam_timestamps, photo_times, video_start=None):
+    self.onsets = np.asarray(cam_timestamps, dtype=float)
+    self.n_frames = len(self.onsets)
+    if video_start is None:
+      video_start = self.onsets[0] if self.n_frames else 0.0
+    self.video_start = video_start
+    self.photo_index = TimeIndex(photo_times)
+    self.n_samples = len(self.photo_index)
+    # sample closest to each frame onset, frame i covers samples[i]:stops[i]
+    self.samples = self.photo_index.nearest(self.onsets)
+    self.stops = np.append(self.samples[1:], self.n_samples)
+    # frame shown at the start of each bin of about one frame interval, for O(1) lookups
+    relative = self.onsets - self.video_start
+    interval = np.median(np.diff(relative)) if self.n_frames > 1 else 1.0
+    self.bin_seconds = interval if interval > 0 else 1.0
+    n_bins = int(max(relative[-1] if self.n_frames else 0, 0) // self.bin_seconds) + 2
+    self.relative = relative
+    self.bin_frames = np.maximum(np.searchsorted(relative, np.arange(n_bins) * self.bin_seconds, side="right") - 1, 0)
+
+  def __len__(self):
+    return self.n_frames
+
+  def frame_at(self, position_ms):
+    '''
+    returns the frame shown at position_ms, the last frame whose onset is at or before it
+    '''
+    t = position_ms / 1000
+    b = int(min(max(t, 0) // self.bin_seconds, len(self.bin_frames) - 1))
+    frame = int(self.bin_frames[b])
+    # at most a couple of frames start inside one bin
+    while frame + 1 < self.n_frames and self.relative[frame + 1] <= t:
+      frame += 1
+    return frame
+
+  def sample_range(self, frame):
+    '''
+    returns a slice with the photometry samples recorded while frame was shown
+    '''
+    return slice(int(self.samples[frame]), int(self.stops[frame]))
+
+  def lookup(self, position_ms):
+    '''
+    returns (frame, frame onset in block time, photometry sample closest to that onset)
+    '''
+    if not self.n_frames:
+      t = self.video_start + position_ms / 1000
+      return 0, t, int(self.photo_index.nearest(t))
+    frame = self.frame_at(position_ms)
+    return frame, self.onsets[frame], int(self.samples[frame])
@@ -1,42 +1,228 @@
 import tdt
 import numpy as np
 import pandas as pd
+import os
+import re
 import datetime
 import scipy.signal
+import functools
+from functools import partial
 from photometry_functions import *
+from decimation import decimate_chunked
+from raw_block import RawBlock
+from timebase import Timebase
+from instrumentation import get_logger, stage, nbytes
+
+log = get_logger("get_tdt_data")
 
 #folder = "/home/matias/Experiments/pilots/photometry/MLA074-220414-141939/"
 
-def get_tdt_data(folder, decimate=True, decimate_factor = 10, remove_start=False, verbose=False):
+# stores used by the viewer, named as in Synapse (tdt prefixes names starting with a digit with "_")
+# load_session reads these, with Cam1 replaced by its cam_name
+DEFAULT_STORES = ["405A", "465A", "Fi1i", "Cam1"]
+
+class TDTSession:
+  '''
+  TDTSession reads a TDT block from disk once and serves streams, scalars and epocs from that read
+  folder: path to the TDT block
+  stores: optional list of store names (as in Synapse, e.g. "405A") passed to tdt.read_block
+          to only parse those stores. None reads the complete block
+  '''
+  def __init__(self, folder, stores=None, verbose=False):
+    if verbose:
+      print(f"Reading data from {folder}")
+    self.folder = folder
+    self.stores = stores
+    with stage("read_block", log=log, folder=folder, stores=stores) as fields:
+      if stores is None:
+        self.data = tdt.read_block(folder)
+      else:
+        self.data = tdt.read_block(folder, store=list(stores))
+      # tdt reads the whole .tsq index plus the data of the selected stores
+      fields.update(block_bytes=sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file()),
+                    stream_bytes=sum(getattr(stream.data, "nbytes", 0) for stream in self.data.streams.values()))
+
+  @staticmethod
+  def var_name(name):
+    # tdt.read_block exposes stores under valid python names (e.g. 405A -> _405A)
+    return tdt.fix_var_name(name)
+
+  @property
+  def info(self):
+    return self.data.info
+
+  def stream_names(self):
+    return list(self.data.streams.keys())
+
+  def stream(self, name):
+    return self.data.streams[self.var_name(name)]
+
+  def scalar(self, name):
+    return self.data.scalars[self.var_name(name)]
+
+  def epoc(self, name):
+    return self.data.epocs[self.var_name(name)]
+
+
+def as_session(folder, verbose=False):
+  '''
+  as_session returns folder untouched if it is already a TDTSession (or a memory-mapped RawBlock),
+  otherwise it reads the complete block at folder
+  '''
+  if isinstance(folder, (TDTSession, RawBlock)):
+    return folder
+  return TDTSession(folder, verbose=verbose)
+
+def decimate_channel(x, decimate_factor=10, chunk_size=None):
+  '''
+  decimate_channel applies the FIR decimation used in get_tdt_data to one channel
+  chunk_size: if given, x is decimated in blocks of chunk_size samples (see decimation.py)
+              so no full-rate temporaries are created
+  '''
+  if chunk_size:
+    return decimate_chunked(x, decimate_factor, block_size=chunk_size)
+  return scipy.signal.decimate(x, decimate_factor, ftype="fir")
+
+class PhotometryData:
+  '''
+  PhotometryData holds a processed session as one array per column instead of a data frame
+  _405, _465: isosbestic and calcium-dependent channels, stored as float32
+  sampling_interval: seconds between consecutive samples (after decimation)
+  start_date, stop_date: start and end of the block
+  zdFF: float32 array, None until calculate_session_zdFF is run
+  stream_fs, decimate_factor: sampling rate of the TDT stream before decimation and the decimation
+  applied, the sample times are exact multiples of decimate_factor / stream_fs. stream_fs defaults
+  to 1 / sampling_interval
+  Columns are read as attributes or with data["zdFF"], to_dataframe gives the columns of get_tdt_data
+  with float32 channels and the times of timebase.
+  The time columns are computed from timebase (see timebase.py) when they are first used
+  '''
+  def __init__(self, _405, _465, sampling_interval, start_date, stop_date, zdFF=None, stream_fs=None, decimate_factor=1):
+    self._405 = np.asarray(_405, dtype=np.float32)
+    self._465 = np.asarray(_465, dtype=np.float32)
+    if len(self._465) != len(self._405) or (zdFF is not None and len(zdFF) != len(self._405)):
+      raise ValueError("all the columns of PhotometryData need the same length")
+    self.sampling_interval = sampling_interval
+    self.start_date = start_date
+    self.stop_date = stop_date
+    self.zdFF = zdFF
+    if stream_fs is None:
+      stream_fs, decimate_factor = 1 / sampling_interval, 1
+    self.stream_fs = stream_fs
+    self.decimate_factor = decimate_factor
+    self.timebase = Timebase(len(self._405), stream_fs, decimate_factor, start=start_date)
+
+  def __len__(self):
+    return len(self._405)
+
+  @property
+  def fs(self):
+    return 1 / self.sampling_interval
+
+  @functools.cached_property
+  def time_seconds(self):
+    return self.timebase.seconds()
+
+  @functools.cached_property
+  def utc_datetime(self):
+    # start_date plus a whole number of sampling periods, stop_date is not used
+    with stage("utc_datetime", log=log, n=len(self)):
+      return self.timebase.datetimes()
+
+  @property
+  def columns(self):
+    columns = ["utc_datetime", "time_seconds", "_405", "_465"]
+    return columns + ["zdFF"] if self.zdFF is not None else columns
+
+  def __getitem__(self, column):
+    if column not in self.columns:
+      raise KeyError(column)
+    return getattr(self, column)
+
+  def to_dataframe(self):
+    return pd.DataFrame({column: self[column] for column in self.columns})
+
+  def to_arrays(self):
+    '''
+    returns the stored arrays and the timebase as 0-d arrays, e.g. to np.save them
+    the time columns are not included, they are rebuilt from the timebase
+    '''
+    arrays = {
+      "_405": self._405,
+      "_465": self._465,
+      "sampling_interval": np.array(self.sampling_interval),
+      "start_date": np.datetime64(self.start_date or "NaT"),
+      "stop_date": np.datetime64(self.stop_date or "NaT"),
+      "stream_fs": np.array(self.stream_fs),
+      "decimate_factor": np.array(self.decimate_factor),
+    }
+    if self.zdFF is not None:
+      arrays["zdFF"] = self.zdFF
+    return arrays
+
+  @classmethod
+  def from_arrays(cls, arrays):
+    date = lambda value: None if np.isnat(value) else pd.Timestamp(value[()])
+    return cls(arrays["_405"], arrays["_465"], float(arrays["sampling_interval"]),
+               date(arrays["start_date"]), date(arrays["stop_date"]), arrays.get("zdFF"),
+               float(arrays["stream_fs"]), int(arrays["decimate_factor"]))
+
+
+def _decimated_streams(session, decimate=True, decimate_factor=10, n_jobs=1, chunk_size=None):
+  # the 405A and 465A streams, decimated unless decimate is False, and their sampling interval
+  _405A = session.stream("405A")
+  _465A = session.stream("465A")
+  sampling_interval = 1 / _405A.fs
+  _405A_data = _405A.data
+  _465A_data = _465A.data
+  if decimate:
+    sampling_interval = sampling_interval * decimate_factor
+    with stage("decimate", log=log, n=len(_405A_data), factor=decimate_factor, chunk_size=chunk_size,
+               bytes_read=nbytes(_405A_data, _465A_data)):
+      _405A_data, _465A_data = map_channels(
+        partial(decimate_channel, decimate_factor=decimate_factor, chunk_size=chunk_size),
+        [_405A_data, _465A_data],
+        n_jobs=n_jobs)
+  return _405A_data, _465A_data, sampling_interval
+
+def get_photometry_data(folder, decimate=True, decimate_factor=10, verbose=False, n_jobs=1, chunk_size=None):
+  '''
+  get_photometry_data reads and decimates the 405A and 465A streams into a PhotometryData
+  folder: path to the TDT block, a TDTSession that was already read or a RawBlock
+  n_jobs: number of workers to decimate the channels in parallel (see map_channels)
+  chunk_size: decimate in blocks of chunk_size samples to bound peak memory (see decimate_channel)
+  '''
+  session = as_session(folder, verbose=verbose)
+  if not decimate:
+    decimate_factor = 1
+  _405A_data, _465A_data, sampling_interval = _decimated_streams(session, decimate, decimate_factor, n_jobs, chunk_size)
+  return PhotometryData(_405A_data, _465A_data, sampling_interval,
+                        session.info.start_date, session.info.stop_date,
+                        stream_fs=session.stream("405A").fs, decimate_factor=decimate_factor)
+
+def get_tdt_data(folder, decimate=True, decimate_factor = 10, remove_start=False, verbose=False, n_jobs=1, chunk_size=None):
   '''
   get_tdt_data is a function to retrieve the data streams as saved by TDT system
   it uses tdt package and will retrieve the complete duration
+  folder: path to the TDT block, a TDTSession that was already read or a RawBlock
+  n_jobs: number of workers to decimate the channels in parallel (see map_channels)
+  chunk_size: decimate in blocks of chunk_size samples to bound peak memory (see decimate_channel)
   returns a data frame with UTC timestamp, time in seconds, and signal values for each channel
+  (get_photometry_data returns the channels as float32 arrays without building the data frame)
   '''
-  if verbose:
-    print(f"Reading data from {folder}")
-  data = tdt.read_block(folder)
-  total_samples = len(data.streams._405A.data)
-  fs = data.streams._405A.fs
+  session = as_session(folder, verbose=verbose)
+  fs = session.stream("405A").fs
+  total_samples = len(session.stream("405A").data)
   # inverse sampling frequency in Hz
-  total_seconds = len(data.streams._405A.data)/fs
-  start_date = data.info.start_date
-  end_date = data.info.stop_date
-  sampling_interval = 1 / fs
-  
-  _405A_data = data.streams._405A.data
-  _465A_data = data.streams._465A.data
+  total_seconds = total_samples/fs
+  start_date = session.info.start_date
+  end_date = session.info.stop_date
   
+  _405A_data, _465A_data, sampling_interval = _decimated_streams(session, decimate, decimate_factor, n_jobs, chunk_size)
   if decimate:
-    sampling_interval = sampling_interval * decimate_factor
-    total_samples = np.ceil(total_samples / decimate_factor)
-    # Decimate
-    _405A_data = scipy.signal.decimate(_405A_data, decimate_factor, ftype="fir")
-    _465A_data = scipy.signal.decimate(_465A_data, decimate_factor, ftype="fir")
+    total_samples = int(np.ceil(total_samples / decimate_factor))
   # UTC datetime
   datetime = pd.date_range(start_date, end_date, periods=total_samples)
-  # time_delta = datetime - start_date
-  # time_delta = time_delta / np.timedelta64(1, 's')
   # using np works for a seconds range
   time_np = np.arange(0, total_seconds, sampling_interval)
 
@@ -47,34 +233,203 @@ def get_tdt_data(folder, decimate=True, decimate_factor = 10, remove_start=False
     "_465" : _465A_data
   })
   
-  # TODO: improve the check for third channel
+  # for other fibers or more than two channels see get_tdt_channels
   
   if remove_start:
     # this will have the times when each laser was turned on
-    laser_on_times = data.scalars.Fi1i.ts
-    # remove from the max moment when leds are on plus 5 seconds
-    remove_before = np.ceil(max(laser_on_times) * fs) + 5 * fs
+    laser_on_times = session.scalar("Fi1i").ts
+    # remove from the max moment when leds are on plus 5 seconds, in rows of df
+    remove_before = int(np.ceil((max(laser_on_times) + 5) / sampling_interval))
     # we only care about the max here 
     # because we end up removing everything before this
-    df = df.iloc[:remove_before]
+    df = df.iloc[remove_before:]
   
   return df
 
 
+# Synapse stream stores are named <wavelength><fiber>, e.g. 405A, 465A, 560B
+STREAM_NAME = re.compile(r"^_?(\d{3})([A-Z])$")
+# wavelengths below this one are used as calcium-independent (isosbestic) reference
+ISOSBESTIC_MAX_WAVELENGTH = 430
+
+def discover_channels(folder):
+  '''
+  discover_channels builds a channel map from the streams in a TDT block
+  folder: path to the TDT block or a TDTSession that was already read
+  returns a list of (isosbestic store, signal store) pairs, one per signal, e.g.
+  [("405A", "465A"), ("405B", "465B"), ("405B", "560B")]
+  '''
+  session = as_session(folder)
+  fibers = {}
+  for var_name in session.stream_names():
+    match = STREAM_NAME.match(var_name)
+    if match is None:
+      continue
+    wavelength, fiber = match.groups()
+    fibers.setdefault(fiber, []).append((int(wavelength), wavelength + fiber))
+  channel_map = []
+  for fiber in sorted(fibers):
+    stores = sorted(fibers[fiber])
+    references = [store for wavelength, store in stores if wavelength < ISOSBESTIC_MAX_WAVELENGTH]
+    signals = [store for wavelength, store in stores if wavelength >= ISOSBESTIC_MAX_WAVELENGTH]
+    if not references:
+      continue
+    for signal in signals:
+      channel_map.append((references[0], signal))
+  return channel_map
+
+
+class PhotometryChannels:
+  '''
+  PhotometryChannels holds every stream of a session stacked in one 2D float32 array
+  data: array of shape (n_stores, n_samples)
+  stores: store name of each row of data
+  pairs: list of (isosbestic row, signal row), one per signal
+  fs: sampling rate of data in Hz (after decimation)
+  stream_fs, decimate_factor: rate of the TDT streams and decimation applied (see PhotometryData)
+  '''
+  def __init__(self, data, stores, pairs, fs, start_date, stop_date, stream_fs=None, decimate_factor=1):
+    self.data = data
+    self.stores = stores
+    self.pairs = pairs
+    self.fs = fs
+    if stream_fs is None:
+      stream_fs, decimate_factor = fs, 1
+    self.stream_fs = stream_fs
+    self.decimate_factor = decimate_factor
+    self.start_date = start_date
+    self.stop_date = stop_date
+
+  def __len__(self):
+    return self.data.shape[1]
+
+  def row(self, store):
+    return self.stores.index(store)
+
+  def channel(self, store):
+    return self.data[self.row(store)]
+
+  @property
+  def time_seconds(self):
+    return Timebase(len(self), self.stream_fs, self.decimate_factor).seconds()
+
+  def pair_names(self):
+    return [(self.stores[i], self.stores[j]) for i, j in self.pairs]
+
+
+def get_tdt_channels(folder, channel_map=None, decimate=True, decimate_factor=10, verbose=False, n_jobs=1, chunk_size=None):
+  '''
+  get_tdt_channels reads any number of isosbestic/signal pairs from a TDT block
+  folder: path to the TDT block or a TDTSession that was already read
+  channel_map: list of (isosbestic store, signal store) pairs, None discovers them (see discover_channels)
+  n_jobs: 1 decimates all the streams in one vectorized call, otherwise one worker per stream
+  chunk_size: decimate each stream in blocks of chunk_size samples (see decimate_channel)
+  returns a PhotometryChannels
+  '''
+  session = as_session(folder, verbose=verbose)
+  if channel_map is None:
+    channel_map = discover_channels(session)
+  stores = []
+  for pair in channel_map:
+    for store in pair:
+      if store not in stores:
+        stores.append(store)
+  pairs = [(stores.index(reference), stores.index(signal)) for reference, signal in channel_map]
+  streams = [session.stream(store) for store in stores]
+  fs = streams[0].fs
+  # streams can differ by a few samples at the end of the recording
+  n = min(len(stream.data) for stream in streams)
+  with stage("decimate_channels", log=log, n=n, n_streams=len(streams), factor=decimate_factor if decimate else 1,
+             chunk_size=chunk_size, bytes_read=n * len(streams) * np.dtype(streams[0].data.dtype).itemsize):
+    if decimate and chunk_size:
+      # read the streams block by block, the full-rate data is never copied
+      fs = fs / decimate_factor
+      data = np.stack(map_channels(partial(decimate_chunked, q=decimate_factor, block_size=chunk_size, length=n),
+                                   [stream.data for stream in streams], n_jobs=n_jobs))
+    else:
+      data = np.empty((len(streams), n), dtype=np.float32)
+      for i, stream in enumerate(streams):
+        data[i] = stream.data[:n]
+      if decimate:
+        fs = fs / decimate_factor
+        if n_jobs == 1:
+          data = scipy.signal.decimate(data, decimate_factor, ftype="fir", axis=1)
+        else:
+          data = np.stack(map_channels(partial(decimate_channel, decimate_factor=decimate_factor),
+                                       list(data), n_jobs=n_jobs))
+  return PhotometryChannels(data.astype(np.float32, copy=False), stores, pairs, fs,
+                            session.info.start_date, session.info.stop_date,
+                            streams[0].fs, decimate_factor if decimate else 1)
+
+
+def get_channels_zdFF(channels, n_remove=5000, n_jobs=1, **kwargs):
+  '''
+  get_channels_zdFF calculates zdFF for every pair in a PhotometryChannels
+  the first n_remove samples are excluded from the calculation and set to zero (as in calculate_zdFF)
+  n_jobs: number of pairs processed in parallel
+  kwargs are passed to get_zdFF (e.g. lambd, porder, itermax)
+  returns a float32 array of shape (n_pairs, n_samples)
+  '''
+  one_second = int(channels.fs)
+  zdFF = np.zeros((len(channels.pairs), len(channels)), dtype=np.float32)
+  fit = partial(_pair_zdFF, smooth_win=one_second, remove=1, **kwargs)
+  inputs = [(channels.data[i, n_remove:], channels.data[j, n_remove:]) for i, j in channels.pairs]
+  for k, values in enumerate(map_channels(fit, inputs, n_jobs=n_jobs)):
+    # same alignment as calculate_zdFF, values start at n_remove
+    values = values[:len(channels) - n_remove]
+    zdFF[k, n_remove:n_remove + len(values)] = values
+  return zdFF
+
+def _pair_zdFF(pair, **kwargs):
+  # get_zdFF converts the rows to its dtype (float64 unless dtype='float32' is passed)
+  return get_zdFF(pair[0], pair[1], **kwargs)
+
+
 def get_cam_timestamps(folder, cam_name="Cam1", verbose=False):
   '''
   get_cam_timestamps is a function to retrieve timestamps from a camera 
   using the data streams as saved by TDT system.
   it uses tdt package and will retrieve the complete duration
+  folder: path to the TDT block or a TDTSession that was already read
   cam_name: string with the camera name as saved configured in Synapse software
   returns the timestamp onset
   '''
-  if verbose:
-    print(f"Reading data from {folder}")
-  data = tdt.read_block(folder)
-  return data.epocs[cam_name].onset
+  session = as_session(folder, verbose=verbose)
+  return session.epoc(cam_name).onset
+
+def calculate_session_zdFF(data, n_remove=5000, **kwargs):
+  '''
+  calculate_session_zdFF sets data.zdFF for a PhotometryData, in place and without copying the channels
+  the first n_remove samples are excluded from the calculation and set to zero (as in calculate_zdFF)
+  kwargs are passed to get_zdFF (e.g. lambd, porder, itermax, dtype='float32' to process the
+  channels in float32, they are stored as float32 anyway)
+  with warm_start (see get_zdFF), reusing the dict after changing n_remove moves its weights accordingly,
+  the baselines then differ slightly from a cold run since the channels changed
+  returns data
+  '''
+  warm_start = kwargs.get("warm_start")
+  if warm_start is not None:
+    # the channels start at n_remove, align the weights of a call with another n_remove
+    for channel in ("reference", "signal"):
+      state = warm_start.setdefault(channel, AirPLSState())
+      state.shift(n_remove - state.offset)
+  time_seconds = data.time_seconds
+  # same estimate of the sampling rate as calculate_zdFF
+  one_second = int(1 / (time_seconds[-1] - time_seconds[-2]))
+  with stage("zdFF", log=log, n=len(data), n_remove=n_remove):
+    values = get_zdFF(data._405[n_remove:], data._465[n_remove:], smooth_win=one_second, remove=1, **kwargs)
+  values = values[:len(data) - n_remove]
+  zdFF = np.zeros(len(data), dtype=np.float32)
+  zdFF[n_remove:n_remove + len(values)] = values
+  data.zdFF = zdFF
+  return data
 
-def calculate_zdFF(photo_data, n_remove=5000):
+def calculate_zdFF(photo_data, n_remove=5000, **kwargs):
+  '''
+  calculate_zdFF adds a zdFF column to the output of get_tdt_data
+  the first n_remove samples are excluded from the calculation and set to zero
+  kwargs are passed to get_zdFF (e.g. lambd, porder, itermax)
+  '''
   photo_subset = photo_data.loc[n_remove:].copy()
   # try to estimate the sampling rate
   one_second = int(1 / photo_subset["time_seconds"].diff().values[-1])
@@ -83,11 +438,12 @@ def calculate_zdFF(photo_data, n_remove=5000):
     photo_subset._405, 
     photo_subset._465, 
     smooth_win=one_second, 
-    remove=1)
+    remove=1,
+    **kwargs)
   
   final_data =  pd.merge(photo_data, photo_subset["zdFF"], 
                          how="left", 
                          left_index=True, right_index=True)
   # make them zero
-  final_data["zdFF"].fillna(0, inplace=True)
+  final_data["zdFF"] = final_data["zdFF"].fillna(0)
   return final_data
@@ -0,0 +1,225 @@
+'''
+instrumentation.py times the stages of the pipeline and collects them for logging and tracing.
+
+Every stage (reading the block, decimation, airPLS, the alignment fit, ...) is wrapped in
+stage(), which logs its wall time and sizes on the "tdt_photo_viewer" loggers at DEBUG level
+and, when a trace is running, adds it to the trace. Traces are written in the Chrome trace
+event format, so they open in chrome://tracing or https://ui.perfetto.dev.
+
+Logging is enabled as usual (e.g. logging.basicConfig(level=logging.DEBUG)), or from the
+environment with configure_from_env():
+  TDT_PHOTO_LOG=DEBUG          log level of the tdt_photo_viewer loggers
+  TDT_PHOTO_TRACE=trace.json   write a trace of the session to this file on exit
+  TDT_PHOTO_MEMORY=1           trace allocations, every stage then also reports peak_bytes
+
+While tracemalloc is tracing, stage() adds peak_bytes to its fields: the highest memory in
+use during the stage above what was in use when it started, numpy arrays included. tracemalloc
+is process wide, so the peak of a stage includes what its worker threads allocate.
+'''
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import contextlib
+import tracemalloc
+import numpy as np
+
+logger = logging.getLogger("tdt_photo_viewer")
+
+_trace = None
+_trace_lock = threading.Lock()
+_trace_start = time.perf_counter()
+# [memory in use at the start, highest peak of the nested stages] of each open stage
+_memory_stack = []
+
+def get_logger(name):
+  # module loggers live under tdt_photo_viewer so they can be enabled together
+  return logger.getChild(name)
+
+def start_trace():
+  '''
+  start collecting stages and events, returns the list they are appended to
+  '''
+  global _trace
+  with _trace_lock:
+    _trace = []
+  return _trace
+
+def stop_trace(path=None):
+  '''
+  stop collecting, writes the trace to path if given and returns its events
+  '''
+  global _trace
+  with _trace_lock:
+    events, _trace = _trace, None
+  if path and events is not None:
+    with open(path, "w") as f:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=_json_default)
+    logger.info("trace with %d events written to %s", len(events), path)
+  return events
+
+def _json_default(value):
+  if isinstance(value, np.generic):
+    return value.item()
+  return str(value)
+
+def _add_event(event):
+  with _trace_lock:
+    if _trace is not None:
+      event.update(pid=os.getpid(), tid=threading.get_ident())
+      _trace.append(event)
+
+def _now_us():
+  return (time.perf_counter() - _trace_start) * 1e6
+
+def event(name, log=None, **fields):
+  '''
+  record a point event, e.g. the iteration count of airPLS
+  only a level check when DEBUG is off and no trace is running (airPLS calls it on every fit)
+  '''
+  log = log or logger
+  if log.isEnabledFor(logging.DEBUG):
+    log.debug("%s %s", name, _format(fields))
+  if _trace is not None:
+    _add_event({"name": name, "ph": "i", "s": "t", "ts": _now_us(), "args": fields})
+
+@contextlib.contextmanager
+def stage(name, log=None, **fields):
+  '''
+  times the enclosed block, fields (e.g. array sizes) are logged and traced with it
+  the yielded dict can be updated with fields only known at the end (e.g. bytes read)
+  '''
+  fields = dict(fields)
+  start = _now_us()
+  memory = _memory_start()
+  try:
+    yield fields
+  finally:
+    duration = _now_us() - start
+    if memory is not None:
+      fields["peak_bytes"] = _memory_stop(memory)
+    log = log or logger
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug("%s took %.3f s %s", name, duration / 1e6, _format(fields))
+    if _trace is not None:
+      _add_event({"name": name, "ph": "X", "ts": start, "dur": duration, "args": fields})
+
+def _memory_start():
+  if not tracemalloc.is_tracing():
+    return None
+  current, peak = tracemalloc.get_traced_memory()
+  with _trace_lock:
+    if _memory_stack:
+      # keep the peak of the enclosing stage before resetting it
+      _memory_stack[-1][1] = max(_memory_stack[-1][1], peak)
+    tracemalloc.reset_peak()
+    memory = [current, current]
+    _memory_stack.append(memory)
+  return memory
+
+def _memory_stop(memory):
+  peak = max(tracemalloc.get_traced_memory()[1], memory[1]) if tracemalloc.is_tracing() else memory[1]
+  with _trace_lock:
+    # stages usually close in order, but may not when they run in several threads
+    _memory_stack[:] = [m for m in _memory_stack if m is not memory]
+    if _memory_stack:
+      _memory_stack[-1][1] = max(_memory_stack[-1][1], peak)
+  return peak - memory[0]
+
+def _format(fields):
+  return " ".join(f"{key}={value}" for key, value in fields.items())
+
+def nbytes(*arrays):
+  '''
+  total size in bytes of arrays or array-likes (memory-maps, SegmentedStream), None are skipped
+  '''
+  total = 0
+  for array in arrays:
+    if array is not None:
+      total += len(array) * np.dtype(array.dtype).itemsize
+  return total
+
+
+class LatencyHistogram:
+  '''
+  LatencyHistogram accumulates durations in log-spaced bins, e.g. the time of each GUI frame update
+  name: used in the log messages and trace events
+  report_every: log (and trace) a summary after this many samples, 0 never reports
+  '''
+  # 1 us to 10 s, 10 bins per decade
+  EDGES = np.logspace(-6, 1, 71)
+
+  def __init__(self, name, report_every=0, log=None):
+    self.name = name
+    self.report_every = report_every
+    self.log = log or logger
+    self.reset()
+
+  def reset(self):
+    self.counts = np.zeros(len(self.EDGES) + 1, dtype=np.int64)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    seconds = float(seconds)
+    self.counts[np.searchsorted(self.EDGES, seconds)] += 1
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+    if self.report_every and self.count % self.report_every == 0:
+      self.report()
+
+  @contextlib.contextmanager
+  def time(self):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(time.perf_counter() - start)
+
+  def percentile(self, q):
+    '''
+    upper edge of the bin holding the q-th percentile (0-100)
+    '''
+    if not self.count:
+      return float("nan")
+    index = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+    return float(self.EDGES[min(index, len(self.EDGES) - 1)])
+
+  def summary(self):
+    return {
+      "count": self.count,
+      "mean_ms": 1e3 * self.total / self.count if self.count else float("nan"),
+      "p50_ms": 1e3 * self.percentile(50),
+      "p95_ms": 1e3 * self.percentile(95),
+      "p99_ms": 1e3 * self.percentile(99),
+      "max_ms": 1e3 * self.max,
+    }
+
+  def report(self):
+    summary = self.summary()
+    if self.log.isEnabledFor(logging.DEBUG):
+      self.log.debug("%s latency %s", self.name, _format({k: round(v, 3) for k, v in summary.items()}))
+    _add_event({"name": self.name, "ph": "C", "ts": _now_us(),
+                "args": {k: v for k, v in summary.items() if k != "count"}})
+
+
+def configure_from_env():
+  '''
+  sets up logging, tracing and memory accounting from TDT_PHOTO_LOG, TDT_PHOTO_TRACE
+  and TDT_PHOTO_MEMORY (see module docstring)
+  '''
+  level = os.environ.get("TDT_PHOTO_LOG")
+  if level:
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logger.setLevel(level.upper())
+  if os.environ.get("TDT_PHOTO_MEMORY") and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  path = os.environ.get("TDT_PHOTO_TRACE")
+  if path:
+    start_trace()
+    atexit.register(stop_trace, path)
@@ -0,0 +1,64 @@
+'''
+lod_pyramid.py keeps a level-of-detail pyramid of a long trace for plotting.
+
+Level k holds the min and max of bins of 2**k samples, each level built from the previous
+one. Drawing a range of the trace then only needs the level whose bins roughly match the
+pixel width of the plot, so the number of points drawn stays in the thousands at any zoom
+while the envelope still shows every peak.
+'''
+
+import numpy as np
+
+class MinMaxPyramid:
+  '''
+  MinMaxPyramid builds per-bin min/max envelopes of y at power-of-two decimations
+  x: sorted 1D array with the time of each sample
+  y: 1D array with the values (e.g. zdFF)
+  '''
+  def __init__(self, x, y):
+    self.x = np.asarray(x)
+    self.y = np.asarray(y)
+    # (bin size, mins, maxs), finest first
+    self.levels = []
+    mins = maxs = self.y
+    size = 1
+    while len(mins) > 1:
+      if len(mins) % 2:
+        # the last bin of the level has a single sample
+        mins = np.append(mins, mins[-1])
+        maxs = np.append(maxs, maxs[-1])
+      mins = np.minimum(mins[0::2], mins[1::2])
+      maxs = np.maximum(maxs[0::2], maxs[1::2])
+      size *= 2
+      self.levels.append((size, mins, maxs))
+
+  def __len__(self):
+    return len(self.y)
+
+  def level_for(self, n_samples, max_points):
+    '''
+    returns the finest level that draws n_samples with at most max_points points, None for raw samples
+    '''
+    if n_samples <= max_points:
+      return None
+    for level, (size, _, _) in enumerate(self.levels):
+      # two points (min and max) per bin
+      if 2 * -(-n_samples // size) <= max_points:
+        return level
+    return len(self.levels) - 1
+
+  def envelope(self, start, stop, max_points=4000):
+    '''
+    returns (x, y) to draw samples start:stop with at most ~max_points points
+    bins are drawn as a vertical segment from their min to their max
+    '''
+    start = max(0, int(start))
+    stop = min(len(self.y), int(stop))
+    level = self.level_for(stop - start, max_points)
+    if level is None:
+      return self.x[start:stop], self.y[start:stop]
+    size, mins, maxs = self.levels[level]
+    first = start // size
+    last = -(-stop // size)
+    x = self.x[np.minimum(np.arange(first, last) * size, len(self.x) - 1)]
+    return np.repeat(x, 2), np.column_stack([mins[first:last], maxs[first:last]]).ravel()
@@ -0,0 +1,235 @@
+'''
+online_zdFF.py estimates zdFF while a session is being recorded.
+
+get_zdFF needs the whole recording: airPLS fits one baseline to the full trace, the channels
+are standardized with the global median and std and the reference is fitted to the signal
+with one global regression. OnlineZdFF takes the (decimated) channels one block at a time and
+keeps every estimate over a trailing window instead, so the cost of each block is bounded
+by the window length and not by the time since the start of the recording:
+  - the moving average smoothing of get_zdFF, centered, so samples come out half a window late
+  - the airPLS baseline, refitted on the last baseline_window seconds of each channel
+  - the standardization, with the median and MAD (or std) of the last standardize_window seconds
+  - the non-negative reference-to-signal slope (fit_positive_slope), from exponentially
+    weighted sums with a time constant of fit_time_constant seconds
+
+replay feeds a recorded block through OnlineZdFF as if it was being acquired, and
+compare_with_batch checks the result against calculate_session_zdFF.
+
+Usage:
+  python online_zdFF.py /path/to/block --block-seconds 1
+'''
+
+import sys
+import time
+import argparse
+import numpy as np
+from photometry_functions import airPLS
+from instrumentation import LatencyHistogram, get_logger
+
+log = get_logger("online_zdFF")
+
+# scales the MAD to the std of normally distributed data
+MAD_TO_STD = 1.4826
+
+class OnlineZdFF:
+  '''
+  OnlineZdFF turns blocks of reference and signal samples into zdFF samples
+  fs: sampling rate of the blocks in Hz (after decimation)
+  smooth_win: moving average window in samples, defaults to one second as in calculate_zdFF
+  baseline_window: seconds of data the airPLS baseline is refitted on for every block
+  lambd, porder, itermax: airPLS parameters, as in get_zdFF
+  standardize_window: seconds of data used for the running median and scale
+  robust: scale with the MAD (robust to transients) instead of the std used by get_zdFF
+  fit_time_constant: time constant in seconds of the reference-to-signal fit
+  alpha: L1 penalty of the fit, as in get_zdFF
+  '''
+  def __init__(self, fs, smooth_win=None, baseline_window=60.0, lambd=5e4, porder=1, itermax=50,
+               standardize_window=60.0, robust=True, fit_time_constant=60.0, alpha=0.0001):
+    self.fs = fs
+    self.smooth_win = int(fs) if smooth_win is None else int(smooth_win)
+    self.baseline_samples = int(baseline_window * fs)
+    self.lambd = lambd
+    self.porder = porder
+    self.itermax = itermax
+    self.standardize_samples = int(standardize_window * fs)
+    self.robust = robust
+    # weight of a sample after one more sample was added to the fit
+    self.decay = np.exp(-1 / (fit_time_constant * fs))
+    self.alpha = alpha
+    self.latency = LatencyHistogram("online_block", log=log)
+    self.reset()
+
+  def reset(self):
+    self.n_in = 0
+    self.n_out = 0
+    # raw samples not yet smoothed, with the history the moving average needs
+    self._raw = np.empty((2, 0))
+    # smoothed channels over the baseline window, and baseline-corrected over the standardization window
+    self._smoothed = np.empty((2, 0))
+    self._corrected = np.empty((2, 0))
+    # exponentially weighted sums of 1, x, y, x*x, x*y for the fit
+    self._sums = np.zeros(5)
+    self.slope = 0.0
+    self.intercept = 0.0
+
+  def _smooth(self, flush=False):
+    '''
+    centered moving average of the buffered raw samples, returns the samples now complete
+    '''
+    w = self.smooth_win
+    half = w // 2
+    if w < 2:
+      out, self._raw = self._raw, self._raw[:, :0]
+      return out
+    raw = self._raw
+    if flush:
+      # hold the last sample past the end of the recording
+      raw = np.concatenate([raw, np.repeat(raw[:, -1:], w - half, axis=1)], axis=1)
+    available = raw.shape[1] - w + 1
+    if available <= 0:
+      return np.empty((2, 0))
+    c = np.zeros((2, raw.shape[1] + 1))
+    np.cumsum(raw, axis=1, out=c[:, 1:])
+    out = (c[:, w:w + available] - c[:, :available]) / w
+    self._raw = self._raw[:, available:]
+    return out
+
+  def _standardize(self, corrected):
+    window = self._corrected
+    center = np.median(window, axis=1, keepdims=True)
+    if self.robust:
+      scale = MAD_TO_STD * np.median(np.abs(window - center), axis=1, keepdims=True)
+    else:
+      scale = np.std(window, axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    return (corrected - center) / scale
+
+  def _fit(self, x, y):
+    '''
+    adds the standardized samples to the weighted sums and updates the slope and intercept
+    '''
+    n = len(x)
+    weights = self.decay ** np.arange(n - 1, -1, -1)
+    block = np.array([weights.sum(), weights @ x, weights @ y, weights @ (x * x), weights @ (x * y)])
+    self._sums = self.decay ** n * self._sums + block
+    total, sx, sy, sxx, sxy = self._sums
+    x_mean = sx / total
+    y_mean = sy / total
+    # same closed form as fit_positive_slope, on weighted moments
+    var = sxx / total - x_mean ** 2
+    cov = sxy / total - x_mean * y_mean
+    self.slope = max(cov - self.alpha, 0.0) / var if var > 0 else 0.0
+    self.intercept = y_mean - self.slope * x_mean
+
+  def _process(self, flush=False):
+    smoothed = self._smooth(flush=flush)
+    n = smoothed.shape[1]
+    if not n:
+      return np.empty(0)
+    self._smoothed = np.concatenate([self._smoothed, smoothed], axis=1)[:, -self.baseline_samples:]
+    corrected = np.empty((2, n))
+    for channel in range(2):
+      window = self._smoothed[channel]
+      if len(window) <= self.porder + 1:
+        # too short for airPLS at the very start of the recording
+        corrected[channel] = window[-n:] - window.mean()
+        continue
+      # only the end of the refitted baseline is used, earlier samples were already emitted
+      baseline = airPLS(window, lambda_=self.lambd, porder=self.porder, itermax=self.itermax)
+      corrected[channel] = window[-n:] - baseline[-n:]
+    self._corrected = np.concatenate([self._corrected, corrected], axis=1)[:, -self.standardize_samples:]
+    reference, signal = self._standardize(corrected)
+    self._fit(reference, signal)
+    self.n_out += n
+    return signal - (self.slope * reference + self.intercept)
+
+  def process(self, reference, signal):
+    '''
+    feeds the next block of both channels, returns the zdFF samples now available
+    (the output lags the input by half the smoothing window, see flush)
+    '''
+    with self.latency.time():
+      reference = np.asarray(reference, dtype=np.float64)
+      signal = np.asarray(signal, dtype=np.float64)
+      block = np.vstack([reference, signal])
+      if not self.n_in and self.smooth_win >= 2:
+        # hold the first sample before the start, like the reflected edges of smooth_signal
+        block = np.concatenate([np.repeat(block[:, :1], self.smooth_win // 2, axis=1), block], axis=1)
+      self.n_in += len(reference)
+      self._raw = np.concatenate([self._raw, block], axis=1)
+      return self._process()
+
+  def flush(self):
+    '''
+    returns the last zdFF samples once the recording stopped
+    '''
+    out = self._process(flush=True)
+    return out[:self.n_in - (self.n_out - len(out))]
+
+
+def replay(photo_data, block_seconds=1.0, **kwargs):
+  '''
+  replay feeds a processed session through OnlineZdFF in blocks of block_seconds
+  photo_data: PhotometryData (see get_photometry_data), its channels are used as acquired
+  kwargs are passed to OnlineZdFF
+  returns (online zdFF with one value per sample, the OnlineZdFF with its latency histogram)
+  '''
+  engine = OnlineZdFF(photo_data.fs, **kwargs)
+  block = max(1, int(block_seconds * photo_data.fs))
+  zdFF = np.empty(len(photo_data), dtype=np.float32)
+  filled = 0
+  for start in range(0, len(photo_data), block):
+    values = engine.process(photo_data._405[start:start + block], photo_data._465[start:start + block])
+    zdFF[filled:filled + len(values)] = values
+    filled += len(values)
+  values = engine.flush()
+  zdFF[filled:filled + len(values)] = values
+  return zdFF, engine
+
+def compare_with_batch(photo_data, n_remove=5000, block_seconds=1.0, warmup_seconds=60.0, **kwargs):
+  '''
+  compare_with_batch replays photo_data and compares it with calculate_session_zdFF
+  samples before n_remove and the first warmup_seconds of the online estimate are excluded
+  returns a dict with the correlation, the RMSE and the per-block latency
+  '''
+  from get_tdt_data import calculate_session_zdFF
+  if photo_data.zdFF is None:
+    calculate_session_zdFF(photo_data, n_remove=n_remove)
+  start = time.perf_counter()
+  online, engine = replay(photo_data, block_seconds=block_seconds, **kwargs)
+  seconds = time.perf_counter() - start
+  first = max(n_remove, int(warmup_seconds * photo_data.fs))
+  online = online[first:].astype(np.float64)
+  batch = photo_data.zdFF[first:].astype(np.float64)
+  return dict(
+    n_samples=len(photo_data),
+    correlation=float(np.corrcoef(online, batch)[0, 1]),
+    rmse=float(np.sqrt(np.mean((online - batch) ** 2))),
+    replay_seconds=seconds,
+    **{f"block_{key}": value for key, value in engine.latency.summary().items()},
+  )
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Replay a TDT block through the online zdFF estimator")
+  parser.add_argument("folder", help="TDT block to replay")
+  parser.add_argument("--block-seconds", type=float, default=1.0, help="seconds of data per block")
+  parser.add_argument("--decimate-factor", type=int, default=10)
+  parser.add_argument("--n-remove", type=int, default=5000)
+  args = parser.parse_args(argv)
+
+  from get_tdt_data import as_session, get_photometry_data
+  from raw_block import RawBlock
+  try:
+    session = RawBlock(args.folder)
+    session.stream("405A"), session.stream("465A")
+  except (KeyError, ValueError, OSError):
+    session = as_session(args.folder)
+  photo_data = get_photometry_data(session, decimate_factor=args.decimate_factor)
+  result = compare_with_batch(photo_data, n_remove=args.n_remove, block_seconds=args.block_seconds)
+  for key, value in result.items():
+    print(f"{key:>16}: {value:.4g}" if isinstance(value, float) else f"{key:>16}: {value}")
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,126 @@
+'''
+peth.py builds peri-event time histograms (event-locked averages) of the photometry signal.
+
+Trials are cut from the processed session (get_photometry_data / calculate_session_zdFF, or the
+get_tdt_data / calculate_zdFF data frame) as rows of a strided view of the signal, so extracting
+thousands of windows is a single fancy-indexing copy with no per-trial loop. Windows that run
+past either end of the recording are padded with NaN and ignored by the statistics.
+'''
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from time_index import TimeIndex
+
+def event_times(session, name):
+  '''
+  event_times returns the onsets (in seconds from the start of the block) of an epoc or scalar store
+  session: a TDTSession or RawBlock (see get_tdt_data.as_session)
+  name: store name as in Synapse, e.g. "Cam1" for camera frames or "Fi1i"
+  '''
+  try:
+    return np.asarray(session.epoc(name).onset)
+  except KeyError:
+    return np.asarray(session.scalar(name).ts)
+
+def extract_windows(y, centers, before, after):
+  '''
+  extract_windows returns an array of shape (len(centers), before + after + 1)
+  row i holds y[centers[i] - before:centers[i] + after + 1], NaN where it falls outside y
+  '''
+  y = np.asarray(y)
+  centers = np.asarray(centers, dtype=np.intp)
+  width = before + after + 1
+  dtype = y.dtype if y.dtype.kind == "f" else np.float64
+  trials = np.full((len(centers), width), np.nan, dtype=dtype)
+  if not len(y):
+    return trials
+  starts = centers - before
+  inside = (starts >= 0) & (starts + width <= len(y))
+  if len(y) >= width:
+    # one row per possible window start, no data is copied until it is indexed
+    windows = sliding_window_view(y, width)
+    trials[inside] = windows[starts[inside]]
+  edge = np.flatnonzero(~inside)
+  if len(edge):
+    index = starts[edge, None] + np.arange(width)
+    valid = (index >= 0) & (index < len(y))
+    trials[edge] = np.where(valid, y[np.clip(index, 0, len(y) - 1)], np.nan)
+  return trials
+
+
+class PETH:
+  '''
+  PETH holds the event-locked trials of one or more sessions
+  trials: array of shape (n_events, n_samples), NaN outside the recordings
+  times: time of each column relative to the event in seconds
+  session: index of the session of each trial (0 for a single session)
+  '''
+  def __init__(self, trials, times, session=None):
+    self.trials = trials
+    self.times = times
+    self.session = np.zeros(len(trials), dtype=int) if session is None else np.asarray(session)
+
+  def __len__(self):
+    return len(self.trials)
+
+  def baseline_corrected(self, start, stop):
+    '''
+    returns a new PETH with the mean of each trial between start and stop (relative seconds) subtracted
+    '''
+    columns = (self.times >= start) & (self.times < stop)
+    baseline = np.nanmean(self.trials[:, columns], axis=1, keepdims=True)
+    return PETH(self.trials - baseline, self.times, self.session)
+
+  def mean(self):
+    return np.nanmean(self.trials, axis=0)
+
+  def sem(self):
+    n = np.sum(~np.isnan(self.trials), axis=0)
+    return np.nanstd(self.trials, axis=0, ddof=1) / np.sqrt(n)
+
+  def heatmap(self, order=None):
+    '''
+    returns the trials as an image (one row per event), rows sorted by order if given
+    e.g. order=np.argsort(peth.trials[:, peth.times > 0].max(axis=1)) sorts by peak response
+    '''
+    return self.trials if order is None else self.trials[np.asarray(order)]
+
+  @classmethod
+  def concatenate(cls, peths):
+    '''
+    stacks the trials of several sessions, they must share the sampling rate and window
+    '''
+    times = peths[0].times
+    for other in peths[1:]:
+      if len(other.times) != len(times) or not np.allclose(other.times, times):
+        raise ValueError("all PETHs need the same window and sampling rate")
+    trials = np.concatenate([p.trials for p in peths])
+    session = np.concatenate([np.full(len(p), i) for i, p in enumerate(peths)])
+    return cls(trials, times, session)
+
+
+def get_peth(photo_data, events, before=2.0, after=5.0, column="zdFF"):
+  '''
+  get_peth cuts a window around every event from one processed session
+  photo_data: PhotometryData or the data frame from calculate_zdFF
+  events: event times in seconds from the start of the block (see event_times)
+  before, after: seconds kept before and after each event
+  column: signal to cut, e.g. "zdFF", "_405" or "_465"
+  returns a PETH, each window is centered on the sample closest to its event
+  '''
+  time_seconds = np.asarray(photo_data["time_seconds"])
+  y = np.asarray(photo_data[column])
+  fs = 1 / (time_seconds[1] - time_seconds[0])
+  n_before = int(round(before * fs))
+  n_after = int(round(after * fs))
+  centers = TimeIndex(time_seconds).nearest(np.asarray(events, dtype=float))
+  trials = extract_windows(y, np.atleast_1d(centers), n_before, n_after)
+  return PETH(trials, np.arange(-n_before, n_after + 1) / fs)
+
+def get_sessions_peth(sessions, before=2.0, after=5.0, column="zdFF"):
+  '''
+  get_sessions_peth pools the trials of many sessions
+  sessions: iterable of (photo_data, events), see get_peth
+  '''
+  return PETH.concatenate([get_peth(photo_data, events, before, after, column)
+                           for photo_data, events in sessions])
@@ -12,7 +12,74 @@ Reference:
 
 '''
 
-def get_zdFF(reference,signal,smooth_win=10,remove=200,lambd=5e4,porder=1,itermax=50): 
+def map_channels(fun, channels, n_jobs=1, backend='thread'):
+  '''
+  Applies fun to every channel and returns the results in the same order
+  
+  Input
+      fun: function taking one channel, must be a module level function for backend='process'
+      channels: list of 1D arrays
+      n_jobs: number of workers, 1 runs sequentially and None or -1 uses all the cores
+      backend: 'thread' (the sparse solves and FIR filtering release the GIL) or 'process'
+  Output
+      list with fun(channel) for each channel
+  '''
+  from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+  
+  n_jobs = min(n_workers(n_jobs), len(channels))
+  if n_jobs <= 1:
+    return [fun(channel) for channel in channels]
+  Executor = ProcessPoolExecutor if backend == 'process' else ThreadPoolExecutor
+  with Executor(max_workers=n_jobs) as pool:
+    return list(pool.map(fun, channels))
+
+
+def n_workers(n_jobs):
+  '''
+  Number of workers used for n_jobs: None or a negative value uses all the cores, at least 1
+  '''
+  import os
+  
+  if n_jobs is None or n_jobs < 0:
+    return os.cpu_count() or 1
+  return max(1, n_jobs)
+
+
+def remove_baseline(x,smooth_win=10,lambd=5e4,porder=1,itermax=50,segment_len=None,segment_overlap=None,state=None,
+                    n_jobs=1):
+  '''
+  Smooths x and removes its airPLS baseline, the per channel part of get_zdFF
+  segment_len: if given, the baseline is fitted in overlapping segments (see airPLS_segmented)
+  n_jobs: number of segments fitted in parallel with segment_len
+  state: AirPLSState to warm-start the airPLS fit from (not available with segment_len)
+  The result has the dtype of x, the baseline itself is always solved in float64
+  '''
+  import numpy as np
+  
+  smoothed = smooth_signal(x, smooth_win)
+  if np.shares_memory(smoothed, x):
+    # short windows return x itself, the baseline is subtracted in place below
+    smoothed = smoothed.copy()
+  x = smoothed
+  if segment_len:
+    if state is not None:
+      raise ValueError("the segmented airPLS fit cannot be warm-started")
+    baseline = airPLS_segmented(x,lambda_=lambd,porder=porder,itermax=itermax,
+                                window=segment_len,overlap=segment_overlap,n_jobs=n_jobs)
+  else:
+    baseline = airPLS(x,lambda_=lambd,porder=porder,itermax=itermax,state=state)
+  # subtract in place so a float32 x stays float32
+  x -= baseline
+  return x
+
+def _remove_channel_baseline(channel, **kwargs):
+  # channel is (x, state), so map_channels can pass each channel its own AirPLSState
+  x, state = channel
+  return remove_baseline(x, state=state, **kwargs)
+
+
+def get_zdFF(reference,signal,smooth_win=10,remove=200,lambd=5e4,porder=1,itermax=50,n_jobs=1,backend='thread',
+             segment_len=None,segment_overlap=None,align='lasso',dtype='float64',warm_start=None): 
   '''
   Calculates z-score dF/F signal based on fiber photometry calcium-idependent 
   and calcium-dependent signals
@@ -28,35 +95,76 @@ def get_zdFF(reference,signal,smooth_win=10,remove=200,lambd=5e4,porder=1,iterma
               the smoother the resulting background, z
       porder: adaptive iteratively reweighted penalized least squares for baseline fitting
       itermax: maximum iteration times
+      n_jobs: number of workers used to process reference and signal in parallel,
+              1 processes them sequentially. With segment_len, each channel fits its
+              segments with half of the workers
+      backend: 'thread' or 'process', see map_channels
+      segment_len: fit the airPLS baseline in overlapping segments of this many samples
+                   for recordings too long for one global fit, None fits the whole trace
+      segment_overlap: samples shared by consecutive segments, defaults to segment_len // 8
+      align: 'lasso' fits the reference to the signal with sklearn's Lasso,
+             'fast' computes the same non-negative slope in closed form (see fit_positive_slope)
+      dtype: 'float64', or 'float32' to keep the channels and every intermediate in float32
+             (half the memory). The airPLS solve and the sums of the standardization and of
+             the fit stay in float64, zdFF differs from the float64 result by ~1e-5 (z units)
+      warm_start: dict filled with the AirPLSState of each channel ('reference' and 'signal'),
+                  passing the same dict to the next call starts its airPLS fits from these
+                  weights, see AirPLSState. They are only reused when smooth_win, lambd, porder
+                  and itermax did not change (kept in AirPLSState.params), so that zdFF is the
+                  same as without warm_start
+                  (e.g. when trying other values of remove or align). After trimming the channels
+                  (see calculate_session_zdFF) the baselines differ slightly from a cold run.
+                  To compare values of lambd use airPLS_sweep. Needs backend='thread'
   Output
       zdFF - z-score dF/F, 1D numpy array
   '''
   
   import numpy as np
-  from sklearn.linear_model import Lasso
-
- # Smooth signal
-  reference = smooth_signal(reference, smooth_win)
-  signal = smooth_signal(signal, smooth_win)
-  
- # Remove slope using airPLS algorithm
-  r_base=airPLS(reference,lambda_=lambd,porder=porder,itermax=itermax)
-  s_base=airPLS(signal,lambda_=lambd,porder=porder,itermax=itermax) 
-
- # Remove baseline and the begining of recording
-  reference = (reference[remove:] - r_base[remove:])
-  signal = (signal[remove:] - s_base[remove:])   
-
- # Standardize signals    
-  reference = (reference - np.median(reference)) / np.std(reference)
-  signal = (signal - np.median(signal)) / np.std(signal)
+  from functools import partial
+
+ # Smooth signal and remove slope using airPLS algorithm, each channel independently
+  states = [None, None]
+  if warm_start is not None:
+    if backend == 'process':
+      raise ValueError("warm_start needs backend='thread', the worker processes cannot update it")
+    params = (smooth_win, lambd, porder, itermax)
+    states = [warm_start.setdefault(channel, AirPLSState()) for channel in ('reference', 'signal')]
+    for state in states:
+      if state.params != params:
+        # weights of other parameters would give another baseline than a cold fit
+        state.reset(params)
+  baseline = partial(_remove_channel_baseline,smooth_win=smooth_win,lambd=lambd,porder=porder,itermax=itermax,
+                     segment_len=segment_len,segment_overlap=segment_overlap,
+                     n_jobs=max(1, n_workers(n_jobs) // 2) if segment_len else 1)
+  channels = [np.asarray(reference, dtype=dtype), np.asarray(signal, dtype=dtype)]
+  with stage("baseline", log=log, n=len(reference), n_jobs=n_jobs, segment_len=segment_len), shared_penalty_bands():
+    reference, signal = map_channels(baseline, list(zip(channels, states)), n_jobs=n_jobs, backend=backend)
+
+ # Remove the begining of recording
+  reference = reference[remove:]
+  signal = signal[remove:]
+
+ # Standardize signals, in place so they keep their dtype
+  for x in (reference, signal):
+    x -= np.median(x)
+    x /= np.std(x, dtype=np.float64)
   
  # Align reference signal to calcium signal using non-negative robust linear regression
-  lin = Lasso(alpha=0.0001,precompute=True,max_iter=1000,
-              positive=True, random_state=9999, selection='random')
-  n = len(reference)
-  lin.fit(reference.reshape(n,1), signal.reshape(n,1))
-  reference = lin.predict(reference.reshape(n,1)).reshape(n,)
+  with stage("align", log=log, n=len(reference), method=align) as fields:
+    if align == 'fast':
+      slope, intercept = fit_positive_slope(reference, signal, alpha=0.0001)
+      reference = slope * reference + intercept
+    elif align == 'lasso':
+      from sklearn.linear_model import Lasso
+      lin = Lasso(alpha=0.0001,precompute=True,max_iter=1000,
+                  positive=True, random_state=9999, selection='random')
+      n = len(reference)
+      lin.fit(reference.reshape(n,1), signal.reshape(n,1))
+      reference = lin.predict(reference.reshape(n,1)).reshape(n,)
+      slope, intercept = lin.coef_[0], np.ravel(lin.intercept_)[0]
+    else:
+      raise ValueError(f"align must be 'lasso' or 'fast', got {align!r}")
+    fields.update(slope=float(slope), intercept=float(intercept))
 
  # z dFF    
   zdFF = (signal - reference)
@@ -64,7 +172,32 @@ def get_zdFF(reference,signal,smooth_win=10,remove=200,lambd=5e4,porder=1,iterma
   return zdFF
 
 
-def smooth_signal(x,window_len=10,window='flat'):
+def fit_positive_slope(x, y, alpha=0.0001):
+  '''
+  Closed form of Lasso(alpha, positive=True) with an intercept for a single predictor:
+  the slope is the least squares slope of the centered data, soft-thresholded by alpha
+  and clamped at zero
+  
+  Input
+      x: predictor (the reference), 1D array
+      y: target (the signal), 1D array
+      alpha: L1 penalty, as in sklearn.linear_model.Lasso
+  Output
+      (slope, intercept) such that y ~ slope * x + intercept
+  '''
+  import numpy as np
+  # the sums are accumulated in float64 whatever the dtype of x and y
+  x_mean = x.mean(dtype=np.float64)
+  y_mean = y.mean(dtype=np.float64)
+  xc = x - x.dtype.type(x_mean)
+  # sklearn scales the squared error by 1 / (2 n)
+  sxx = np.mean(xc * xc, dtype=np.float64)
+  sxy = np.mean(xc * (y - y.dtype.type(y_mean)), dtype=np.float64)
+  slope = float(max(sxy - alpha, 0.0) / sxx) if sxx > 0 else 0.0
+  return slope, float(y_mean - slope * x_mean)
+
+
+def smooth_signal(x,window_len=10,window='flat',out=None):
 
     """smooth the data using a window with requested size.
     
@@ -73,41 +206,22 @@ def smooth_signal(x,window_len=10,window='flat'):
     (with the window size) in both ends so that transient parts are minimized
     in the begining and end part of the output signal.
     The code taken from: https://scipy-cookbook.readthedocs.io/items/SignalSmooth.html
+    and computed in O(n) by smoothing.smooth (cumulative sum for 'flat', FFT otherwise)
     
     input:
         x: the input signal 
         window_len: the dimension of the smoothing window; should be an odd integer
         window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
                 'flat' window will produce a moving average smoothing.
+        out: optional preallocated output array (see smoothing.output_length)
 
     output:
         the smoothed signal        
     """
     
-    import numpy as np
-
-    if x.ndim != 1:
-        raise(ValueError, "smooth only accepts 1 dimension arrays.")
-
-    if x.size < window_len:
-        raise(ValueError, "Input vector needs to be bigger than window size.")
-
-    if window_len<3:
-        return x
+    from smoothing import smooth
 
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise(ValueError, "Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
-    s=np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
-
-    if window == 'flat': # Moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-
-    y=np.convolve(w/w.sum(),s,mode='valid')
-
-    return y[(int(window_len/2)-1):-int(window_len/2)]
+    return smooth(x, window_len, window, out=out)
 
 
 '''
@@ -150,9 +264,92 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>
 '''
 
+import math
+import contextlib
 import numpy as np
-from scipy.sparse import csc_matrix, eye, diags
-from scipy.sparse.linalg import spsolve
+from scipy.linalg import solveh_banded
+from instrumentation import get_logger, event, stage
+
+log = get_logger("photometry_functions")
+
+# penalty bands shared by the solvers created inside shared_penalty_bands(), None outside
+_shared_bands = None
+
+@contextlib.contextmanager
+def shared_penalty_bands():
+    '''
+    Solvers of the same length and parameters created inside the block (and in the threads
+    it starts) share their penalty bands, e.g. the reference and signal channels in get_zdFF.
+    The bands are released when the outermost block exits, so they are not kept for the
+    life of the process
+    '''
+    global _shared_bands
+    outermost = _shared_bands is None
+    if outermost:
+        _shared_bands = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            _shared_bands = None
+
+def _penalty_bands(m, lambda_, differences=1):
+    '''
+    Upper banded storage of lambda_ * D.T * D, where D is the (m - differences) x m
+    difference matrix of the given order. The result is laid out as expected by
+    scipy.linalg.solveh_banded (main diagonal in the last row), see shared_penalty_bands
+    '''
+    shared = _shared_bands
+    if shared is not None and (m, lambda_, differences) in shared:
+        return shared[(m, lambda_, differences)]
+    d = differences
+    # coefficients of one row of D, e.g. [-1, 1] for first differences
+    c = np.array([(-1) ** (d - j) * math.comb(d, j) for j in range(d + 1)], dtype=float)
+    bands = np.zeros((d + 1, m))
+    for k in range(d + 1):
+        for j in range(d + 1 - k):
+            bands[d - k, j + k:j + k + m - d] += c[j] * c[j + k]
+    bands *= lambda_
+    bands.setflags(write=False)
+    if shared is not None:
+        shared[(m, lambda_, differences)] = bands
+    return bands
+
+class WhittakerSolver:
+    '''
+    Penalized least squares engine for signals of a fixed length
+
+    The penalty lambda_ * D.T * D only depends on the length of the signal, lambda_
+    and the order of the differences, so it is built once and only the weights change
+    between solves. The system W + lambda_ * D.T * D is symmetric, positive definite and
+    banded (bandwidth = differences), so each solve is a banded Cholesky in O(m).
+
+    input
+        m: length of the signals that will be smoothed
+        lambda_: parameter that can be adjusted by user. The larger lambda is,
+                 the smoother the resulting background
+        differences: integer indicating the order of the difference of penalties
+    '''
+    def __init__(self, m, lambda_, differences=1):
+        self.m = m
+        self.lambda_ = lambda_
+        self.differences = differences
+        self.bands = _penalty_bands(m, lambda_, differences)
+        # workspace reused across solves, solveh_banded overwrites it
+        self._work = np.empty_like(self.bands)
+
+    def solve(self, x, w):
+        '''
+        input
+            x: input data, 1D array of length m
+            w: weights, 1D array of length m
+        output
+            the fitted background vector
+        '''
+        np.copyto(self._work, self.bands)
+        self._work[-1] += w
+        return solveh_banded(self._work, w * x, overwrite_ab=True, overwrite_b=True,
+                             check_finite=False)
 
 def WhittakerSmooth(x,w,lambda_,differences=1):
     '''
@@ -164,22 +361,78 @@ def WhittakerSmooth(x,w,lambda_,differences=1):
         lambda_: parameter that can be adjusted by user. The larger lambda is, 
                  the smoother the resulting background
         differences: integer indicating the order of the difference of penalties
+                     (before the banded solver the penalty was always first order)
     
     output
         the fitted background vector
     '''
-    X=np.matrix(x)
-    m=X.size
-    i=np.arange(0,m)
-    E=eye(m,format='csc')
-    D=E[1:]-E[:-1] # numpy.diff() does not work with sparse matrix. This is a workaround.
-    W=diags(w,0,shape=(m,m))
-    A=csc_matrix(W+(lambda_*D.T*D))
-    B=csc_matrix(W*X.T)
-    background=spsolve(A,B)
-    return np.array(background)
+    x=np.asarray(x,dtype=float)
+    return WhittakerSolver(x.shape[0],lambda_,differences).solve(x,w)
 
-def airPLS(x, lambda_=100, porder=1, itermax=15):
+class AirPLSState:
+    '''
+    Weights and solver of an airPLS fit, used to warm-start the next one
+
+    airPLS(x, state=state) starts from state.weights instead of ones and stores its final
+    weights, solver and iteration count back in state, so fitting the same or a similar
+    signal again (a sweep over lambda_, the session after trimming more samples, ...)
+    takes fewer iterations. airPLS stops at the first weights that pass its convergence
+    test, so a warm-started baseline passes the same test as a cold one but is only
+    identical to it when x and the parameters did not change
+
+    input
+        weights: initial weights, None starts from ones like a cold fit
+    
+    params and offset are bookkeeping for the callers: params holds the parameters the weights
+    were fitted with (see get_zdFF) and offset the position of the fitted signal in the recording,
+    moved by shift (see calculate_session_zdFF)
+    '''
+    def __init__(self, weights=None):
+        self.weights = weights
+        self.solver = None
+        self.iterations = 0
+        self.converged = False
+        self.params = None
+        self.offset = 0
+
+    def reset(self, params=None):
+        '''
+        forget the weights and solver, the next fit starts cold. offset is kept
+        '''
+        self.weights = None
+        self.solver = None
+        self.params = params
+
+    def initial_weights(self, m):
+        '''
+        weights for a signal of m samples, samples past the end of the previous fit start from one
+        '''
+        w = np.ones(m)
+        if self.weights is not None:
+            n = min(m, len(self.weights))
+            w[:n] = self.weights[:n]
+        return w
+
+    def get_solver(self, m, lambda_, differences=1):
+        '''
+        the solver of the previous fit if it has the same length and parameters, a new one otherwise
+        '''
+        solver = self.solver
+        if solver is None or (solver.m, solver.lambda_, solver.differences) != (m, lambda_, differences):
+            solver = WhittakerSolver(m, lambda_, differences)
+        return solver
+
+    def shift(self, n):
+        '''
+        the next signal starts n samples after the previous one (e.g. n_remove grew by n),
+        a negative n for a signal starting earlier
+        '''
+        if self.weights is not None and n:
+            self.weights = self.weights[n:] if n > 0 else np.concatenate([np.ones(-n), self.weights])
+        self.solver = None
+        self.offset += n
+
+def airPLS(x, lambda_=100, porder=1, itermax=15, state=None):
     '''
     Adaptive iteratively reweighted penalized least squares for baseline fitting
     
@@ -187,23 +440,171 @@ def airPLS(x, lambda_=100, porder=1, itermax=15):
         x: input data (i.e. chromatogram of spectrum)
         lambda_: parameter that can be adjusted by user. The larger lambda is,
                  the smoother the resulting background, z
-        porder: adaptive iteratively reweighted penalized least squares for baseline fitting
+        porder: order of the difference penalty (differences in WhittakerSmooth). The original
+                solver always used first differences, so porder=2 now gives a different baseline
+        state: AirPLSState to warm-start from, updated with the weights of this fit
     
     output
         the fitted background vector
     '''
+    x=np.asarray(x)
+    if x.dtype!=np.float32:
+        # float32 input is used as is, the residuals and the solve are float64 either way
+        x=x.astype(float,copy=False)
     m=x.shape[0]
-    w=np.ones(m)
+    warm=state is not None and state.weights is not None
+    w=state.initial_weights(m) if state is not None else np.ones(m)
+    solver=state.get_solver(m,lambda_,porder) if state is not None else WhittakerSolver(m,lambda_,porder)
+    scale=np.abs(x).sum(dtype=float)
+    # residuals and their sign, reused by every iteration
+    d=np.empty(m)
+    neg=np.empty(m,dtype=bool)
     for i in range(1,itermax+1):
-        z=WhittakerSmooth(x,w,lambda_, porder)
-        d=x-z
-        dssn=np.abs(d[d<0].sum())
-        if(dssn<0.001*(abs(x)).sum() or i==itermax):
-            if(i==itermax): print('WARING max iteration reached!')
+        z=solver.solve(x,w)
+        np.subtract(x,z,out=d)
+        np.less(d,0,out=neg)
+        dssn=np.abs(d.sum(where=neg))
+        if(dssn<0.001*scale or i==itermax):
+            # residual is relative to the signal, airPLS converges below 0.001
+            residual=dssn/scale if scale else 0.0
+            if(dssn>=0.001*scale):
+                log.warning('airPLS did not converge in %d iterations (residual %.2e, n=%d)', itermax, residual, m)
+            event("airPLS", log=log, n=m, iterations=i, residual=float(residual), converged=bool(dssn<0.001*scale),
+                  warm_start=warm)
             break
-        w[d>=0]=0 # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
-        w[d<0]=np.exp(i*np.abs(d[d<0])/dssn)
-        w[0]=np.exp(i*(d[d<0]).max()/dssn) 
+        w.fill(0) # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
+        d*=-i/dssn # i*|d|/dssn where d<0
+        np.exp(d,out=w,where=neg)
+        w[0]=np.exp(-d.min(where=neg,initial=np.inf))
         w[-1]=w[0]
+    if state is not None:
+        state.weights=w
+        state.solver=solver
+        state.iterations=i
+        state.converged=bool(dssn<0.001*scale)
+    return z
+
+def _segment_starts(m, window, overlap):
+    '''
+    Start of each segment, consecutive segments share at least overlap samples
+    and the last one ends at m
+    '''
+    step = window - overlap
+    starts = list(range(0, max(m - window, 0) + 1, step))
+    if starts[-1] + window < m:
+        starts.append(m - window)
+    return starts
+
+def iter_airPLS_segments(x, lambda_=100, porder=1, itermax=15, window=2**16, overlap=None, n_jobs=1):
+    '''
+    Segmented airPLS baseline, yielded in order as it is finalized
+    
+    input
+        x: input data, any 1D array-like (e.g. a numpy.memmap), read one segment at a time
+        lambda_, porder, itermax: as in airPLS
+        window: number of samples of each segment
+        overlap: samples shared by consecutive segments, at most window // 2, defaults to window // 8.
+                 The two fits are blended with linear weights across the overlap
+        n_jobs: number of segments fitted in parallel (see map_channels)
+    
+    output
+        yields (start, baseline) pieces that cover x contiguously
+    '''
+    from functools import partial
+    m=len(x)
+    if overlap is None:
+        overlap=window//8
+    if 2*overlap>window:
+        raise ValueError("overlap can be at most half of the window")
+    starts=_segment_starts(m,window,overlap)
+    fit=partial(airPLS,lambda_=lambda_,porder=porder,itermax=itermax)
+    n_jobs=n_workers(n_jobs)
+    batch=n_jobs
+    prev_stop=0
+    prev_tail=None
+    for first in range(0,len(starts),batch):
+        batch_starts=starts[first:first+batch]
+        segments=[np.asarray(x[a:a+window],dtype=float) for a in batch_starts]
+        with shared_penalty_bands():
+            fits=map_channels(fit,segments,n_jobs=n_jobs) if len(segments)>1 else [fit(segments[0])]
+        for i,(a,z) in enumerate(zip(batch_starts,fits),start=first):
+            ov=prev_stop-a
+            if ov>0:
+                w=np.arange(1,ov+1)/(ov+1)
+                z[:ov]=(1-w)*prev_tail+w*z[:ov]
+            next_start=starts[i+1] if i+1<len(starts) else m
+            yield a, z[:next_start-a]
+            prev_tail=z[next_start-a:]
+            prev_stop=a+len(z)
+
+def airPLS_segmented(x, lambda_=100, porder=1, itermax=15, window=2**16, overlap=None, n_jobs=1):
+    '''
+    airPLS fitted on overlapping segments with blended seams, so memory and time grow
+    linearly with the length of x. See iter_airPLS_segments for the inputs
+    
+    output
+        the fitted background vector
+    '''
+    z=np.empty(len(x))
+    for start,piece in iter_airPLS_segments(x,lambda_,porder,itermax,window,overlap,n_jobs):
+        z[start:start+len(piece)]=piece
     return z
 
+def airPLS_sweep(x, lambdas, porder=1, itermax=15, warm_start=False, n_jobs=1):
+    '''
+    airPLS baselines of x for many values of lambda_, e.g. to tune lambd of get_zdFF
+
+    input
+        x: input data
+        lambdas: values of lambda_ to fit
+        porder, itermax: as in airPLS
+        warm_start: False fits each lambda_ from scratch, the baselines are the ones
+                    get_zdFF(lambd=lambda_) computes. True fits the lambdas in increasing order,
+                    each one starting from the weights of the previous one (see AirPLSState):
+                    fewer iterations, but the baselines are NOT the ones of a cold fit (they
+                    can differ by a fraction of the std of x), see compare_warm_start
+        n_jobs: the sorted lambdas are split in n_jobs chains fitted in parallel (see map_channels)
+
+    output
+        (baselines, iterations): array of shape (len(lambdas), len(x)) with one baseline per
+        lambda_ in the order of lambdas, and the number of iterations of each fit
+    '''
+    lambdas=np.atleast_1d(np.asarray(lambdas,dtype=float))
+    n_jobs=n_workers(n_jobs)
+    baselines=np.empty((len(lambdas),len(x)))
+    iterations=np.zeros(len(lambdas),dtype=int)
+
+    def chain(indices):
+        state=AirPLSState()
+        for k in indices:
+            if not warm_start:
+                state=AirPLSState()
+            baselines[k]=airPLS(x,lambdas[k],porder,itermax,state=state)
+            iterations[k]=state.iterations
+
+    chains=np.array_split(np.argsort(lambdas,kind='stable'),max(1,min(n_jobs,len(lambdas))))
+    with stage("airPLS_sweep", log=log, n=len(x), n_lambdas=len(lambdas), warm_start=warm_start) as fields:
+        map_channels(chain,chains,n_jobs=n_jobs)
+        fields.update(iterations=int(iterations.sum()))
+    return baselines, iterations
+
+def compare_warm_start(x, lambdas, porder=1, itermax=15, n_jobs=1):
+    '''
+    Runs airPLS_sweep cold and warm-started on x
+
+    output
+        dict with the iterations of each lambda_ for both sweeps, the total iterations saved
+        by the warm start and the distance of each warm baseline to the cold one
+        (max absolute difference divided by the std of x)
+    '''
+    cold,cold_iterations=airPLS_sweep(x,lambdas,porder,itermax,warm_start=False,n_jobs=n_jobs)
+    warm,warm_iterations=airPLS_sweep(x,lambdas,porder,itermax,warm_start=True,n_jobs=n_jobs)
+    std=np.std(x)
+    distance=np.abs(warm-cold).max(axis=1)/(std if std else 1.0)
+    return dict(
+        lambdas=np.atleast_1d(np.asarray(lambdas,dtype=float)),
+        cold_iterations=cold_iterations,
+        warm_iterations=warm_iterations,
+        iterations_saved=int(cold_iterations.sum()-warm_iterations.sum()),
+        distance=distance,
+    )
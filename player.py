@@ -42,7 +42,7 @@
 
 
 from PyQt5.QtCore import (pyqtSignal, pyqtSlot, Q_ARG, QAbstractItemModel,
-        QFileInfo, qFuzzyCompare, QModelIndex, Qt, QTime, QUrl)
+        QFileInfo, qFuzzyCompare, QModelIndex, QObject, QRunnable, Qt, QThreadPool, QTime, QUrl)
 from PyQt5.QtGui import QPalette
 from PyQt5.QtMultimedia import (QAbstractVideoBuffer, QMediaContent,
         QMediaMetaData, QMediaPlayer, QMediaPlaylist, QVideoFrame, QVideoProbe)
@@ -55,7 +55,17 @@ import numpy as np
 from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
 import os
-from get_tdt_data import *
+import importlib
+from functools import partial
+# the processing modules (tdt, pandas, scipy, scikit-learn) are imported when the first
+# session is loaded or by ModulePreloader, so the window shows up without waiting for them
+from time_index import TimeIndex
+from frame_alignment import FrameAlignment
+from scrolling_trace import ScrollingTrace
+from lod_pyramid import MinMaxPyramid
+from instrumentation import LatencyHistogram, configure_from_env, get_logger, stage
+
+log = get_logger("player")
 
 class VideoWidget(QVideoWidget):
 
@@ -303,10 +313,78 @@ class FrameCounterWidget(QLabel):
         self.frame_cnt = 0
         self.setText('0')
 
-    @pyqtSlot(QVideoFrame)
-    def processFrame(self, frame):
-        self.frame_cnt = self.frame_cnt + 1
-        self.setText(str(self.frame_cnt))
+    def setFrame(self, frame):
+        # the frame comes from the alignment table, counting decoded frames drifts after seeks
+        if frame != self.frame_cnt:
+            self.frame_cnt = frame
+            self.setText(str(frame))
+
+class LoadCancelled(Exception):
+    pass
+
+
+class SessionLoaderSignals(QObject):
+
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+
+class SessionLoader(QRunnable):
+    """Loads and processes a TDT block off the GUI thread.
+
+    Progress messages are emitted between stages, and cancel() makes the
+    loader stop at the next stage without emitting its result.
+    """
+
+    def __init__(self, root_folder):
+        super(SessionLoader, self).__init__()
+        self.root_folder = root_folder
+        self.signals = SessionLoaderSignals()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, message):
+        if self.cancelled:
+            raise LoadCancelled()
+        self.signals.progress.emit(message)
+
+    def run(self):
+        try:
+            from session_cache import load_session
+            # one worker per channel
+            with stage("load_session", log=log, folder=self.root_folder):
+                result = load_session(self.root_folder, progress=self.report, n_jobs=None, reader="mmap")
+        except LoadCancelled:
+            return
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.error.emit(str(e))
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(result)
+
+
+class ModulePreloader(QRunnable):
+    """Imports the processing modules in the background once the window is shown.
+
+    Only the import time is saved, a session opened before it finishes waits for
+    the import to complete like it would without the preloader.
+    """
+
+    MODULES = ("session_cache", "sklearn.linear_model")
+
+    def run(self):
+        for name in self.MODULES:
+            try:
+                with stage("preload_import", log=log, module=name):
+                    importlib.import_module(name)
+            except ImportError as e:
+                # e.g. scikit-learn is only needed for the Lasso alignment
+                log.debug("could not preload %s: %s", name, e)
+
 
 class Player(QWidget):
 
@@ -319,6 +397,13 @@ class Player(QWidget):
         self.trackInfo = ""
         self.statusInfo = ""
         self.duration = 0
+        self.y_range = None
+        self.trace = None
+        self.alignment = None
+        self.loader = None
+        # time spent in onNewData for each video frame, summarized every ~10 s of playback
+        self.frameLatency = LatencyHistogram("frame_update", report_every=300, log=log)
+        self.threadPool = QThreadPool.globalInstance()
 
         self.player = QMediaPlayer()
         self.playlist = QMediaPlaylist()
@@ -366,8 +451,18 @@ class Player(QWidget):
         self.plotDataItem.setZValue(10)
         self.graphWidget.setLabels(bottom='Time (sec)', left='zdFF')
 
+        # Full session overview, drawn from a min/max pyramid so zooming stays cheap
+        self.pyramid = None
+        self.overviewWidget = pg.PlotWidget()
+        self.overviewWidget.setMaximumHeight(150)
+        self.overviewWidget.setLabels(bottom='Time (sec)', left='zdFF')
+        self.overviewItem = self.overviewWidget.plot([], pen=(255,0,0))
+        self.overviewItem.setClipToView(True)
+        self.positionLine = pg.InfiniteLine(angle=90, movable=False, pen=pg.mkPen(color='w'))
+        self.overviewWidget.addItem(self.positionLine, ignoreBounds=True)
+        self.overviewWidget.getViewBox().sigXRangeChanged.connect(self.updateOverview)
+
         self.probe = QVideoProbe()
-        self.probe.videoFrameProbed.connect(self.frameCounter.processFrame)
         self.probe.videoFrameProbed.connect(self.onNewData)
         self.probe.setSource(self.player)
 
@@ -420,6 +515,7 @@ class Player(QWidget):
         layout.addLayout(hLayout)
         layout.addLayout(controlLayout)
         layout.addWidget(self.graphWidget)
+        layout.addWidget(self.overviewWidget)
 
         self.setLayout(layout)
 
@@ -443,8 +539,8 @@ class Player(QWidget):
         # TODO: This is subsetting only the first file, we assume video and data live in the same TDT folder
         # We also assume we will only have 1 file in fileNames...
         self.root_folder = os.path.dirname(fileNames[0])
-        # get the data
-        self.get_data()
+        # get the data in the background, the video can play meanwhile
+        self.get_data_async()
 
     def addToPlaylist(self, fileNames):
         # TODO: This is effectively loading whatever you have in that folder
@@ -506,20 +602,11 @@ class Player(QWidget):
         self.move(position_ - 15000)
 
     def move(self, new_pos):
+        # the frame and the plot follow the position, see onNewData
         self.player.setPosition(new_pos)
-        # expressed in milliseconds since the beginning of the media
-        # position_ms = self.player.position()
-        # update the framecounter to the proper position
-        current_frame = np.argmin(np.abs(new_pos/1000 - self.timestamps))
-        self.frameCounter.frame_cnt = int(current_frame)
     
     def seek(self, seconds):
         self.player.setPosition(seconds * 1000)
-        # expressed in milliseconds since the beginning of the media
-        # position_ms = self.player.position()
-        # update the framecounter to the proper position
-        current_frame = np.argmin(np.abs(seconds - self.timestamps))
-        self.frameCounter.frame_cnt = int(current_frame)
 
     def statusChanged(self, status):
         self.handleCursor(status)
@@ -604,42 +691,98 @@ class Player(QWidget):
         self.labelDuration.setText(tStr)
 
     # Plots here
-    def setData(self, x, y):
-        self.graphWidget.setYRange(np.min(y) - 5, np.max(y) + 5, padding=0)
-        x_range = np.max(x) - np.min(x)
-        self.graphWidget.setXRange(np.min(x) - 5, np.max(x) + x_range , padding=0)
+    def setData(self, x, y, y_range=None):
+        if y_range is None:
+            y_range = (np.min(y), np.max(y))
+        y_range = (y_range[0] - 5, y_range[1] + 5)
+        # only touch the axes when the ranges change, it triggers a relayout
+        if y_range != self.y_range:
+            self.graphWidget.setYRange(*y_range, padding=0)
+            self.y_range = y_range
+        x_min, x_max = x[0], x[-1]
+        self.graphWidget.setXRange(x_min - 5, x_max + (x_max - x_min), padding=0)
         self.plotDataItem.setData(x, y)
 
     def onNewData(self):
-        # get the current frame
-        current_frame = self.frameCounter.frame_cnt
-        previous_frame = current_frame - 1
-        # get the position in time
-        previous_second = self.timestamps[previous_frame]
-        current_second = self.timestamps[current_frame]
-        # get the closest samples
-        previous_closest = self.find_closest(previous_second)
-        current_closest = self.find_closest(current_second)
-        # We add a buffer before here
+        # the photometry might still be loading
+        if self.trace is None:
+            return
+        with self.frameLatency.time():
+            # frame shown at the current position (expressed in milliseconds since the beginning of the media)
+            current_frame, current_second, current_closest = self.alignment.lookup(self.player.position())
+            self.frameCounter.setFrame(current_frame)
+            # the trace keeps the visible window and only appends the new samples
+            x, y = self.trace.update(current_closest)
+            if len(y):
+                self.setData(x, y, self.trace.y_range())
+            self.positionLine.setValue(current_second)
+
+    def updateOverview(self):
+        if self.pyramid is None:
+            return
+        x_min, x_max = self.overviewWidget.getViewBox().viewRange()[0]
+        visible = self.photo_index.window(x_min, x_max)
+        # about one min/max pair per pixel
+        width = max(self.overviewWidget.width(), 100)
+        x, y = self.pyramid.envelope(visible.start, visible.stop, max_points=2 * width)
+        self.overviewItem.setData(x, y)
+
+    def preloadModules(self):
+        self.threadPool.start(ModulePreloader())
+
+    def get_data_async(self):
+        # a previous load is no longer needed if the user opened another file
+        if self.loader is not None:
+            self.loader.cancel()
+        self.trace = None
+        self.alignment = None
+        self.pyramid = None
+        self.plotDataItem.setData([], [])
+        self.overviewItem.setData([], [])
+        loader = SessionLoader(self.root_folder)
+        loader.signals.progress.connect(self.setStatusInfo)
+        loader.signals.finished.connect(partial(self.loadingFinished, loader))
+        loader.signals.error.connect(partial(self.loadingFailed, loader))
+        self.loader = loader
+        self.threadPool.start(loader)
+
+    def loadingFinished(self, loader, session):
+        # results from a loader that was replaced by a newer one are dropped
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.setStatusInfo("")
+        self.setSessionData(session)
+
+    def loadingFailed(self, loader, message):
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.setStatusInfo("Could not load photometry: %s" % message)
+
+    def setSessionData(self, session):
+        self.timestamps, self.photo_data = session
+        self.time_seconds = self.photo_data.time_seconds
+        # sorted index used by the overview, the alignment maps each camera frame to its samples
+        self.photo_index = TimeIndex(self.time_seconds)
+        self.alignment = FrameAlignment(self.timestamps, self.time_seconds)
+        self.frameCounter.setFrame(self.alignment.frame_at(self.player.position()))
+        # visible window of the live plot, we keep a buffer before the current sample
         # this is the sampling rate approx
         sampling_rate = 1000
-        previous_closest = max(0, previous_closest - 5 * sampling_rate)
-        self.setData(self.photo_data.time_seconds.values[previous_closest:current_closest], self.photo_data.zdFF.values[previous_closest:current_closest])
-
-    def find_closest(self, frame_sec):
-        return np.argmin(np.abs(frame_sec - self.time_seconds))
-
-    def get_data(self):
-        self.timestamps = get_cam_timestamps(self.root_folder)
-        self.photo_data = get_tdt_data(self.root_folder, remove_start=False)
-        self.time_seconds = self.photo_data.time_seconds.values
-        # TODO calculate dF/F here or change this to read the calculated dF/F elsewhere   
-        self.photo_data = calculate_zdFF(self.photo_data)
+        self.trace = ScrollingTrace(self.time_seconds, self.photo_data.zdFF, 5 * sampling_rate)
+        # overview of the whole session, the x range is set by us and by zooming
+        self.pyramid = MinMaxPyramid(self.time_seconds, self.photo_data.zdFF)
+        self.overviewWidget.enableAutoRange(x=False)
+        self.overviewWidget.setXRange(self.time_seconds[0], self.time_seconds[-1], padding=0)
+        self.updateOverview()
 
 if __name__ == '__main__':
 
     import sys
 
+    # TDT_PHOTO_LOG=DEBUG and TDT_PHOTO_TRACE=trace.json enable the stage timings (see instrumentation.py)
+    configure_from_env()
     app = QApplication(sys.argv)
 
     player = Player(sys.argv[1:])
@@ -647,5 +790,6 @@ if __name__ == '__main__':
     w.setCentralWidget(player)
     w.statusBar()
     w.show()
+    player.preloadModules()
 
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(app.exec_())
@@ -0,0 +1,286 @@
+'''
+raw_block.py gives memory-mapped access to the streams of a TDT block without tdt.read_block.
+
+Streams saved as .sev files are exposed as numpy.memmap views (zero-copy), streams saved in
+the .tev file are exposed as SegmentedStream objects that use the .tsq index to only read the
+chunks that are sliced. Opening a block only parses the .tsq index, so it takes a fraction of
+a second regardless of the size of the recording, and samples are read from disk on access.
+
+RawBlock has the same stream/epoc/scalar/info interface as TDTSession, so it can be passed to
+get_tdt_data and get_cam_timestamps (use chunk_size in get_tdt_data to decimate without
+loading the full-rate streams). SEV recordings with gaps, or that started late, are not handled
+here: the <store>_log.txt files are parsed as in tdt.read_sev and stream() raises ValueError for
+those stores, read them with tdt.read_block (which zero-fills the gaps).
+'''
+
+import os
+import re
+import glob
+import datetime
+import numpy as np
+
+# tsq event header, 40 bytes per event
+TSQ_DTYPE = np.dtype([
+  ("size", "<i4"),        # event size in 4 byte words, header included
+  ("type", "<i4"),        # event type, see EVTYPE_*
+  ("code", "<u4"),        # store name, 4 chars
+  ("channel", "<u2"),
+  ("sortcode", "<u2"),
+  ("timestamp", "<f8"),   # seconds since epoch
+  ("offset", "<i8"),      # data offset in the .tev file (or strobe value for epocs)
+  ("format", "<i4"),      # index in DATA_FORMATS
+  ("frequency", "<f4"),
+])
+TSQ_HEADER_WORDS = 10
+EVTYPE_STRON = 0x0101
+EVTYPE_SCALAR = 0x0201
+EVTYPE_STREAM = 0x8101
+EVTYPE_MARK = 0x8801
+EVTYPE_MASK = 0xFF0F
+EVMARK_STARTBLOCK = 0x0001
+EVMARK_STOPBLOCK = 0x0002
+DATA_FORMATS = [np.float32, np.int32, np.int16, np.int8, np.float64, np.int64]
+SEV_HEADER_BYTES = 40
+# timestamps are rounded to this clock, as tdt.read_block does
+TIMESTAMP_FS = 195312.5
+
+def code_to_name(code):
+  return int(code).to_bytes(4, byteorder="little").decode("cp437")
+
+def store_name(name):
+  # undo tdt.fix_var_name, which prefixes stores starting with a digit with "_"
+  return name[1:] if name.startswith("_") and name[1:2].isdigit() else name
+
+
+class SegmentedStream:
+  '''
+  SegmentedStream is a read-only 1D array-like made of consecutive segments on disk
+  slicing only reads the segments that overlap the requested samples
+  segment: function returning segment i as a 1D array (e.g. a view of a memory-map)
+  lengths: number of samples of each segment
+  '''
+  def __init__(self, segment, lengths, dtype):
+    self.segment = segment
+    self.starts = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    self.dtype = np.dtype(dtype)
+
+  def __len__(self):
+    return int(self.starts[-1])
+
+  @property
+  def shape(self):
+    return (len(self),)
+
+  @property
+  def ndim(self):
+    return 1
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(len(self))
+      if step != 1:
+        return self[start:stop][::step] if step > 0 else self[stop + 1:start + 1][::step]
+      if stop <= start:
+        return np.empty(0, dtype=self.dtype)
+      first = np.searchsorted(self.starts, start, side="right") - 1
+      last = np.searchsorted(self.starts, stop, side="left")
+      parts = [self.segment(i) for i in range(first, last)]
+      out = np.concatenate(parts) if len(parts) > 1 else np.array(parts[0])
+      offset = self.starts[first]
+      return out[start - offset:stop - offset]
+    i = int(key)
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("index out of range")
+    s = np.searchsorted(self.starts, i, side="right") - 1
+    return self.segment(s)[i - self.starts[s]]
+
+  def __array__(self, dtype=None, copy=None):
+    out = self[:]
+    return out if dtype is None else out.astype(dtype)
+
+
+class RawStream:
+  '''
+  RawStream holds a memory-mapped stream channel, data is a numpy.memmap or a SegmentedStream
+  '''
+  def __init__(self, name, data, fs, channel=1, start_time=0.0):
+    self.name = name
+    self.data = data
+    self.fs = fs
+    self.channel = channel
+    self.start_time = start_time
+
+
+class RawEvents:
+  '''
+  RawEvents holds the timestamps (in seconds from the start of the block) of an epoc or scalar store
+  '''
+  def __init__(self, name, onset, data):
+    self.name = name
+    self.onset = onset
+    self.ts = onset
+    self.data = data
+
+
+class RawBlockInfo:
+  def __init__(self, start_date, stop_date, blockname):
+    self.start_date = start_date
+    self.stop_date = stop_date
+    self.blockname = blockname
+
+
+def read_sev_logs(folder):
+  '''
+  read_sev_logs parses the _log.txt files of the SEV stores like tdt.read_sev
+  returns {store name: [(hour, first sample, array of (last saved, new saved) sample gaps)]}
+  '''
+  start_search = re.compile(r"recording started at sample: (\d*)")
+  gap_search = re.compile(r"gap detected. last saved sample: (\d*), new saved sample: (\d*)")
+  hour_search = re.compile(r"-(\d)h")
+  logs = {}
+  for path in glob.glob(os.path.join(folder, "*_log.txt")):
+    name = os.path.basename(path)
+    if name.startswith("._"):
+      continue
+    with open(path, "r") as f:
+      text = f.read()
+    start = start_search.findall(text)
+    hour = hour_search.findall(name)
+    gaps = np.array(gap_search.findall(text), dtype=np.int64).reshape(-1, 2)
+    # tdt.read_sev takes the store name from the first 4 characters of the file name
+    logs.setdefault(name[:4], []).append((int(hour[-1]) if hour else 0, int(start[0]) if start else 1, gaps))
+  return logs
+
+
+def read_sev_header(path):
+  '''
+  read_sev_header returns (event name, channel, dtype, fs) from the 40 byte header of a .sev file
+  '''
+  with open(path, "rb") as f:
+    header = f.read(SEV_HEADER_BYTES)
+  version = header[11]
+  if header[8:11] != b"SEV" or version == 0 or version >= 4:
+    raise ValueError(f"{path} has no supported SEV header")
+  event_name = header[12:16].decode("cp437")
+  channel, n_channels, width = np.frombuffer(header[16:22], dtype="<u2")
+  data_format = header[24] & 0b111
+  decimate = header[25]
+  rate = np.frombuffer(header[26:28], dtype="<u2")[0]
+  fs = 2.0 ** (float(rate) - 12) * 25000000 / decimate
+  return event_name, int(channel), np.dtype(DATA_FORMATS[data_format]), fs
+
+
+class RawBlock:
+  '''
+  RawBlock memory-maps the streams of the TDT block in folder (see module docstring)
+  '''
+  def __init__(self, folder, verbose=False):
+    if verbose:
+      print(f"Memory-mapping data from {folder}")
+    self.folder = folder
+    tsq_files = glob.glob(os.path.join(folder, "*.tsq"))
+    self.heads = None
+    self.tev = None
+    start_time = stop_time = np.nan
+    if tsq_files:
+      n_heads = os.path.getsize(tsq_files[0]) // TSQ_DTYPE.itemsize
+      self.heads = np.memmap(tsq_files[0], dtype=TSQ_DTYPE, mode="r", shape=(n_heads,))
+      # the first header is the file header, then the start block marker
+      if self.heads[1]["code"] == EVMARK_STARTBLOCK:
+        start_time = self.heads[1]["timestamp"]
+      if self.heads[-1]["code"] == EVMARK_STOPBLOCK:
+        stop_time = self.heads[-1]["timestamp"]
+      tev_file = tsq_files[0][:-4] + ".tev"
+      if os.path.exists(tev_file) and os.path.getsize(tev_file):
+        self.tev = np.memmap(tev_file, dtype=np.uint8, mode="r")
+    self.start_time = start_time
+    self.info = RawBlockInfo(
+      datetime.datetime.fromtimestamp(start_time) if np.isfinite(start_time) else None,
+      datetime.datetime.fromtimestamp(stop_time) if np.isfinite(stop_time) else None,
+      os.path.basename(os.path.normpath(folder)))
+    self.sev_files = self._find_sev_files()
+    self.sev_logs = read_sev_logs(folder)
+
+  def _find_sev_files(self):
+    '''
+    returns {(event name, channel): [paths sorted by hour]}
+    '''
+    hour_search = re.compile(r"-(\d+)h")
+    files = {}
+    for path in glob.glob(os.path.join(self.folder, "*.sev")):
+      if os.path.basename(path).startswith("._"):
+        continue
+      event_name, channel, _, _ = read_sev_header(path)
+      hour = hour_search.findall(os.path.basename(path))
+      files.setdefault((event_name, channel), []).append((int(hour[-1]) if hour else 0, path))
+    return {key: [path for _, path in sorted(paths)] for key, paths in files.items()}
+
+  def _store_heads(self, name, types):
+    code = int.from_bytes(name.encode("cp437"), byteorder="little")
+    heads = self.heads[self.heads["code"] == code]
+    return heads[np.isin(heads["type"] & EVTYPE_MASK, types)]
+
+  def stream_names(self):
+    names = {event_name for event_name, _ in self.sev_files}
+    if self.heads is not None:
+      is_stream = (self.heads["type"] & EVTYPE_MASK) == EVTYPE_STREAM
+      names.update(code_to_name(code) for code in np.unique(self.heads["code"][is_stream]))
+    return sorted(names)
+
+  def stream(self, name, channel=1):
+    name = store_name(name)
+    if (name, channel) in self.sev_files:
+      return self._sev_stream(name, channel)
+    return self._tev_stream(name, channel)
+
+  def _sev_stream(self, name, channel):
+    for hour, start, gaps in self.sev_logs.get(name, []):
+      # the samples of the file are not contiguous from the start of the block,
+      # concatenating them would shift everything after the gap
+      if len(gaps):
+        raise ValueError(f"{name} has {len(gaps)} gaps in hour {hour}, read this block with tdt.read_block")
+      if start > 2 and hour == 0:
+        raise ValueError(f"{name} starts at sample {start}, read this block with tdt.read_block")
+    paths = self.sev_files[(name, channel)]
+    _, _, dtype, fs = read_sev_header(paths[0])
+    maps = [np.memmap(path, dtype=dtype, mode="r", offset=SEV_HEADER_BYTES) for path in paths]
+    data = maps[0] if len(maps) == 1 else SegmentedStream(maps.__getitem__, [len(m) for m in maps], dtype)
+    return RawStream(name, data, fs, channel)
+
+  def _tev_stream(self, name, channel):
+    if self.heads is None or self.tev is None:
+      raise KeyError(f"stream {name} not found in {self.folder}")
+    heads = self._store_heads(name, [EVTYPE_STREAM])
+    heads = heads[heads["channel"] == channel]
+    if not len(heads):
+      raise KeyError(f"stream {name} channel {channel} not found in {self.folder}")
+    dtype = np.dtype(DATA_FORMATS[heads["format"][0]])
+    offsets = np.asarray(heads["offset"])
+    lengths = (np.asarray(heads["size"], dtype=np.int64) - TSQ_HEADER_WORDS) * 4 // dtype.itemsize
+    tev = self.tev
+    segment = lambda i: np.frombuffer(tev, dtype=dtype, count=int(lengths[i]), offset=int(offsets[i]))
+    return RawStream(name, SegmentedStream(segment, lengths, dtype), float(heads["frequency"][0]), channel,
+                     heads["timestamp"][0] - self.start_time)
+
+  def _events(self, name, types):
+    if self.heads is None:
+      raise KeyError(f"no tsq file in {self.folder}")
+    heads = self._store_heads(store_name(name), types)
+    if not len(heads):
+      raise KeyError(f"store {name} not found in {self.folder}")
+    return heads
+
+  def _event_times(self, heads):
+    sample = (np.asarray(heads["timestamp"]) - self.start_time) * TIMESTAMP_FS
+    return np.round(np.round(sample * 1e9) / 1e9) / TIMESTAMP_FS
+
+  def epoc(self, name):
+    heads = self._events(name, [EVTYPE_STRON, EVTYPE_MARK])
+    # for epocs the offset field holds the value as a double
+    return RawEvents(name, self._event_times(heads), np.asarray(heads["offset"]).view(np.float64))
+
+  def scalar(self, name):
+    heads = self._events(name, [EVTYPE_SCALAR])
+    return RawEvents(name, self._event_times(heads), None)
@@ -0,0 +1,71 @@
+'''
+scrolling_trace.py keeps the visible window of the live plot in a preallocated ring buffer.
+
+Every video frame only the samples between the previous and the current frame are copied in
+(one slice assignment per buffer), so playback does not allocate new arrays on each frame.
+The y range is the min/max of the visible window, a single vectorized pass over it.
+'''
+
+import numpy as np
+
+class ScrollingTrace:
+  '''
+  ScrollingTrace serves the last `window` samples of (x, y) up to a moving stop index
+  x, y: 1D arrays with the full session (e.g. time_seconds and zdFF)
+  window: number of samples kept visible
+  '''
+  def __init__(self, x, y, window):
+    self.x = x
+    self.y = y
+    self.window = int(window)
+    # each sample is written twice (at i and i + window) so the visible
+    # window is always a contiguous view of the buffer
+    self._x = np.zeros(2 * self.window, dtype=np.float64)
+    self._y = np.zeros(2 * self.window, dtype=np.float64)
+    self.reset(0)
+
+  def reset(self, stop):
+    '''
+    refill the buffer with the window ending at stop, used at start and after seeks
+    '''
+    stop = int(np.clip(stop, 0, len(self.y)))
+    self.head = 0
+    self.count = 0
+    self.stop = max(0, stop - self.window)
+    self._append(stop)
+
+  def _append(self, stop):
+    w = self.window
+    # only the last window samples can be visible
+    start = max(self.stop, stop - w)
+    n = stop - start
+    pos = self.head
+    # samples up to the end of the buffer, then the rest wraps around to the start
+    k = min(n, w - pos)
+    for buffer, values in ((self._x, self.x[start:stop]), (self._y, self.y[start:stop])):
+      buffer[pos:pos + k] = buffer[pos + w:pos + w + k] = values[:k]
+      buffer[:n - k] = buffer[w:w + n - k] = values[k:]
+    self.head = (pos + n) % w
+    self.count = min(self.count + n, w)
+    self.stop = stop
+
+  def update(self, stop):
+    '''
+    move the end of the visible window to stop (exclusive) and return the (x, y) views
+    '''
+    stop = int(np.clip(stop, 0, len(self.y)))
+    if stop < self.stop or stop - self.stop > self.window:
+      self.reset(stop)
+    elif stop > self.stop:
+      self._append(stop)
+    return self.view()
+
+  def view(self):
+    start = (self.head - self.count) % self.window if self.count == self.window else 0
+    return self._x[start:start + self.count], self._y[start:start + self.count]
+
+  def y_range(self):
+    if not self.count:
+      return None
+    _, y = self.view()
+    return y.min(), y.max()
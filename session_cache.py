@@ -0,0 +1,186 @@
+'''
+session_cache.py keeps processed sessions (decimated streams, zdFF and camera timestamps)
+on disk so reopening a TDT block does not re-run decimation, airPLS and the Lasso fit.
+
+Each entry is a folder with one .npy file per array, so it can be memory-mapped back,
+and a meta.json. Entries are keyed by the block fingerprint (name, size and mtime of every
+file in the TDT folder) plus the processing parameters, and the least recently used entries
+are evicted once the cache grows past max_bytes.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from get_tdt_data import *
+from instrumentation import get_logger, event
+
+log = get_logger("session_cache")
+
+# bump when the processing changes in a way that invalidates previously cached sessions
+CACHE_VERSION = 3
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+def default_cache_dir():
+  root = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(root, "tdt_photo_viewer")
+
+def block_fingerprint(folder):
+  '''
+  block_fingerprint lists (name, size, mtime) for every file in the TDT block folder
+  any change to the raw files on disk changes the fingerprint
+  '''
+  fingerprint = []
+  for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+    if entry.is_file():
+      stat = entry.stat()
+      fingerprint.append([entry.name, stat.st_size, stat.st_mtime_ns])
+  return fingerprint
+
+
+class SessionCache:
+  '''
+  SessionCache stores dictionaries of numpy arrays on disk keyed by block fingerprint and parameters
+  cache_dir: where entries are written, defaults to $XDG_CACHE_HOME/tdt_photo_viewer
+  max_bytes: total size of the cache before the least recently used entries are evicted
+  '''
+  def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    self.cache_dir = cache_dir or default_cache_dir()
+    self.max_bytes = max_bytes
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  def key(self, folder, **params):
+    payload = {
+      "version": CACHE_VERSION,
+      "folder": os.path.abspath(folder),
+      "files": block_fingerprint(folder),
+      "params": params,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, key, mmap_mode="r"):
+    '''
+    returns a dict of arrays (memory-mapped by default) or None if key is not cached
+    an entry with missing or truncated files is removed and treated as not cached
+    '''
+    entry = self.path(key)
+    meta_file = os.path.join(entry, "meta.json")
+    if not os.path.exists(meta_file):
+      return None
+    try:
+      with open(meta_file) as f:
+        meta = json.load(f)
+      arrays = {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode=mmap_mode)
+                for name in meta["arrays"]}
+    except (OSError, ValueError) as error:
+      log.warning("removing broken cache entry %s: %s", entry, error)
+      shutil.rmtree(entry, ignore_errors=True)
+      return None
+    # mark as recently used
+    os.utime(entry)
+    return arrays
+
+  def put(self, key, arrays):
+    '''
+    writes a dict of arrays under key and evicts old entries if needed
+    '''
+    tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+    try:
+      for name, values in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), np.asarray(values))
+      with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"arrays": list(arrays)}, f)
+      entry = self.path(key)
+      if os.path.exists(entry):
+        shutil.rmtree(entry)
+      os.replace(tmp, entry)
+    except BaseException:
+      shutil.rmtree(tmp, ignore_errors=True)
+      raise
+    self.evict(keep=key)
+
+  def entries(self):
+    '''
+    returns a list of (last used, size in bytes, key) for every cached entry
+    '''
+    out = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.is_dir() and not entry.name.startswith("."):
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        out.append((entry.stat().st_mtime, size, entry.name))
+    return out
+
+  def evict(self, keep=None):
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+      if total <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      shutil.rmtree(self.path(key), ignore_errors=True)
+      total -= size
+
+  def clear(self):
+    for _, _, key in self.entries():
+      shutil.rmtree(self.path(key), ignore_errors=True)
+
+
+def load_session(folder, cam_name="Cam1", decimate_factor=10, n_remove=5000, cache=None, verbose=False, progress=None, n_jobs=1, reader="tdt", chunk_size=2**20, **zdFF_kwargs):
+  '''
+  load_session returns the camera timestamps and the processed PhotometryData (with zdFF)
+  for the TDT block in folder, use its to_dataframe() for the calculate_zdFF data frame.
+  Results are read from cache when available and written to it otherwise.
+  cache: a SessionCache, None uses the default cache, False disables caching
+  progress: optional callable, called with a short message before each stage
+  n_jobs: number of workers used to process the channels in parallel (see map_channels)
+  reader: "tdt" reads the block with tdt.read_block, "mmap" memory-maps the raw files (see raw_block.py)
+          and decimates them in blocks of chunk_size samples, falling back to tdt.read_block
+          for blocks it cannot map
+  zdFF_kwargs: extra parameters for get_zdFF (lambd, porder, itermax, segment_len, segment_overlap, align)
+  '''
+  if progress is None:
+    progress = lambda message: None
+  if cache is None:
+    cache = SessionCache()
+  # the readers take the sampling rate from different headers, keep their results apart
+  params = dict(cam_name=cam_name, decimate_factor=decimate_factor, n_remove=n_remove, reader=reader, **zdFF_kwargs)
+  key = cache.key(folder, **params) if cache else None
+  arrays = cache.get(key) if cache else None
+  event("session_cache", log=log, folder=folder, hit=arrays is not None)
+  if arrays is not None:
+    progress("Loading from cache")
+    if verbose:
+      print(f"Loading {folder} from cache {cache.path(key)}")
+    timestamps = arrays.pop("cam_timestamps")
+    return timestamps, PhotometryData.from_arrays(arrays)
+
+  progress("Reading TDT block")
+  session = None
+  if reader == "mmap":
+    try:
+      session = RawBlock(folder, verbose=verbose)
+      timestamps = get_cam_timestamps(session, cam_name=cam_name)
+      session.stream("405A"), session.stream("465A")
+    except (KeyError, ValueError, OSError):
+      session = None
+  if session is None:
+    stores = [cam_name if store == "Cam1" else store for store in DEFAULT_STORES]
+    session = TDTSession(folder, stores=stores, verbose=verbose)
+    timestamps = get_cam_timestamps(session, cam_name=cam_name)
+    chunk_size = None
+  progress("Decimating streams")
+  photo_data = get_photometry_data(session, decimate_factor=decimate_factor, n_jobs=n_jobs, chunk_size=chunk_size)
+  progress("Calculating zdFF")
+  photo_data = calculate_session_zdFF(photo_data, n_remove=n_remove, n_jobs=n_jobs, **zdFF_kwargs)
+  if cache:
+    progress("Writing cache")
+    arrays = photo_data.to_arrays()
+    arrays["cam_timestamps"] = timestamps
+    cache.put(key, arrays)
+  return timestamps, photo_data
@@ -0,0 +1,102 @@
+'''
+smoothing.py has the moving window smoothing used by smooth_signal, in O(n) per sample count.
+
+The signal is padded with reflected copies at both ends and convolved with a normalized
+window, exactly as in the scipy cookbook recipe smooth_signal was taken from, but the flat
+window (moving average) is computed from a cumulative sum and the other windows with
+overlap-add FFT convolution, so the cost no longer grows with the window length.
+float32 inputs stay float32 and the result can be written into a preallocated array.
+'''
+
+import numpy as np
+from scipy.signal import oaconvolve
+
+WINDOWS = {
+  'flat': np.ones,
+  'hanning': np.hanning,
+  'hamming': np.hamming,
+  'bartlett': np.bartlett,
+  'blackman': np.blackman,
+}
+# below this window length a direct convolution is faster than the O(n) methods
+DIRECT_MAX_WINDOW = 16
+
+def reflect_pad(x, window_len):
+  '''
+  x with window_len - 1 reflected samples (edge excluded) added at both ends
+  '''
+  return np.concatenate([x[window_len-1:0:-1], x, x[-2:-window_len-1:-1]])
+
+def output_length(n, window_len):
+  '''
+  number of samples returned for a signal of n samples, n + 1 for odd windows (as the cookbook recipe)
+  and n for windows shorter than 3, which leave the signal unchanged
+  '''
+  if window_len < 3:
+    return n
+  return n + window_len - 2 * (window_len // 2)
+
+def moving_average(x, window_len, out=None):
+  '''
+  flat window smoothing of x, see smooth
+  '''
+  s = reflect_pad(x, window_len)
+  first = window_len // 2 - 1
+  n_out = output_length(len(x), window_len)
+  # removing the mean keeps the cumulative sum small, so the differences stay accurate
+  s = s.astype(np.float64, copy=False)
+  offset = s.mean()
+  s -= offset
+  c = np.empty(len(s) + 1)
+  c[0] = 0
+  np.cumsum(s, out=c[1:])
+  window_sum = c[first + window_len:first + window_len + n_out] - c[first:first + n_out]
+  window_sum /= window_len
+  window_sum += offset
+  if out is None:
+    return window_sum.astype(x.dtype if x.dtype == np.float32 else np.float64, copy=False)
+  out[:] = window_sum
+  return out
+
+def window_convolve(x, window_len, window='hanning', out=None):
+  '''
+  smoothing of x with any window, see smooth
+  '''
+  dtype = np.float32 if x.dtype == np.float32 else np.float64
+  s = reflect_pad(x, window_len).astype(dtype, copy=False)
+  w = WINDOWS[window](window_len).astype(dtype)
+  if window_len <= DIRECT_MAX_WINDOW:
+    y = np.convolve(w / w.sum(), s, mode='valid')
+  else:
+    y = oaconvolve(s, w / w.sum(), mode='valid')
+  y = y[window_len // 2 - 1:][:output_length(len(x), window_len)]
+  if out is None:
+    return y
+  out[:] = y
+  return out
+
+def smooth(x, window_len=10, window='flat', out=None):
+  '''
+  smooth returns the same samples as smooth_signal (the scipy cookbook recipe)
+  x: 1D array, float32 inputs give float32 outputs
+  window_len: length of the window, windows shorter than 3 return x unchanged (copied into out if given)
+  window: 'flat' (moving average), 'hanning', 'hamming', 'bartlett' or 'blackman'
+  out: optional array of output_length(len(x), window_len) samples to write the result into
+  '''
+  x = np.asarray(x)
+  if x.ndim != 1:
+    raise ValueError("smooth only accepts 1 dimension arrays.")
+  if x.size < window_len:
+    raise ValueError("Input vector needs to be bigger than window size.")
+  if out is not None and len(out) != output_length(len(x), window_len):
+    raise ValueError(f"out must have {output_length(len(x), window_len)} samples")
+  if window_len < 3:
+    if out is None:
+      return x
+    out[:] = x
+    return out
+  if window not in WINDOWS:
+    raise ValueError("Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+  if window == 'flat' and window_len > DIRECT_MAX_WINDOW:
+    return moving_average(x, window_len, out=out)
+  return window_convolve(x, window_len, window, out=out)
@@ -0,0 +1,28 @@
+'''
+test_decimation.py checks the chunked FIR decimation against scipy.signal.decimate, run with:
+  python -m pytest -q
+'''
+
+import numpy as np
+import pytest
+import scipy.signal
+
+from decimation import decimate_chunked
+from benchmark import synthetic_signal
+
+
+@pytest.mark.parametrize("q, block_size", [(10, 4096), (10, 1000), (4, 333)])
+def test_decimate_chunked_matches_scipy(q, block_size):
+  x = synthetic_signal(50000, fs=1017.25).astype(np.float32)
+  expected = scipy.signal.decimate(x, q, ftype="fir")
+  got = decimate_chunked(x, q, block_size=block_size)
+  assert got.dtype == np.float32 and len(got) == len(expected)
+  np.testing.assert_allclose(got, expected, rtol=0, atol=1e-4)
+
+def test_decimate_chunked_blocks_and_length():
+  x = synthetic_signal(50000, fs=1017.25)
+  expected = scipy.signal.decimate(x[:45000], 10, ftype="fir")
+  np.testing.assert_allclose(decimate_chunked(x, 10, block_size=4096, length=45000), expected, rtol=0, atol=1e-9)
+  # an iterable of blocks, as read from disk
+  blocks = (x[i:i + 3000] for i in range(0, 45000, 3000))
+  np.testing.assert_allclose(decimate_chunked(blocks, 10), expected, rtol=0, atol=1e-9)
@@ -0,0 +1,38 @@
+'''
+test_frame_alignment.py checks the video position to frame and sample table, run with:
+  python -m pytest -q
+'''
+
+import numpy as np
+
+from frame_alignment import FrameAlignment
+
+
+def test_matches_binary_search():
+  rng = np.random.default_rng(0)
+  fps, fs = 30, 101.7
+  onsets = 0.25 + np.cumsum(rng.uniform(0.9, 1.1, 20 * 60 * fps) / fps)
+  photo_times = np.arange(int((onsets[-1] + 1) * fs)) / fs
+  alignment = FrameAlignment(onsets, photo_times)
+  positions = rng.uniform(-1000, (onsets[-1] - onsets[0]) * 1000 + 1000, 10000)
+  frames = np.array([alignment.frame_at(p) for p in positions])
+  expected = np.maximum(np.searchsorted(onsets - onsets[0], positions / 1000, side="right") - 1, 0)
+  np.testing.assert_array_equal(frames, expected)
+  samples = [np.argmin(np.abs(photo_times - onsets[f])) for f in frames[:200]]
+  np.testing.assert_array_equal(alignment.samples[frames[:200]], samples)
+  frame, onset, sample = alignment.lookup(positions[0])
+  assert (frame, onset, sample) == (frames[0], onsets[frames[0]], samples[0])
+
+def test_single_frame():
+  alignment = FrameAlignment([2.0], np.arange(1000) / 100)
+  assert alignment.frame_at(-50) == alignment.frame_at(5000) == 0
+  assert alignment.lookup(0) == (0, 2.0, 200)
+
+def test_no_frames_maps_position_to_block_time():
+  photo_times = np.arange(1000) / 100
+  alignment = FrameAlignment(np.array([]), photo_times)
+  assert len(alignment) == 0 and alignment.video_start == 0
+  assert alignment.frame_at(1234) == 0
+  assert alignment.lookup(1234) == (0, 1.234, 123)
+  assert alignment.lookup(10**6)[2] == 999
+  assert FrameAlignment([], photo_times, video_start=2).lookup(500) == (0, 2.5, 250)
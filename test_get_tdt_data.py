@@ -0,0 +1,93 @@
+'''
+test_get_tdt_data.py checks the loaders of get_tdt_data.py on blocks built in memory, run with:
+  python -m pytest -q
+'''
+
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.signal
+import tdt
+
+from get_tdt_data import TDTSession, get_tdt_data, get_photometry_data, calculate_session_zdFF
+from smoothing import output_length
+from benchmark import synthetic_pair
+
+# 24414.0625 / 24 Hz as TDT stores it, the rate of the 405A/465A streams
+FS = float(np.float32(24414.0625 / 24))
+
+
+def make_session(seconds=60, laser_on=(0.5, 1.2)):
+  '''
+  a TDTSession with the 405A/465A streams and Fi1i scalar that tdt.read_block would return
+  '''
+  n = int(seconds * FS)
+  reference, signal = synthetic_pair(n, fs=FS)
+  data = tdt.StructType()
+  data.streams = tdt.StructType()
+  data.streams._405A = tdt.StructType(data=reference, fs=FS)
+  data.streams._465A = tdt.StructType(data=signal, fs=FS)
+  data.scalars = tdt.StructType()
+  data.scalars.Fi1i = tdt.StructType(ts=np.array(laser_on))
+  start = datetime.datetime(2022, 4, 15, 5, 20)
+  data.info = tdt.StructType(start_date=start, stop_date=start + datetime.timedelta(seconds=n / FS))
+  session = TDTSession.__new__(TDTSession)
+  session.folder, session.stores, session.data = "block", None, data
+  return session
+
+
+def baseline_get_tdt_data(data, decimate=True, decimate_factor=10):
+  # get_tdt_data before the loaders were reworked, on the output of tdt.read_block
+  total_samples = len(data.streams._405A.data)
+  fs = data.streams._405A.fs
+  total_seconds = len(data.streams._405A.data)/fs
+  sampling_interval = 1 / fs
+  _405A_data = data.streams._405A.data
+  _465A_data = data.streams._465A.data
+  if decimate:
+    sampling_interval = sampling_interval * decimate_factor
+    total_samples = np.ceil(total_samples / decimate_factor)
+    _405A_data = scipy.signal.decimate(_405A_data, decimate_factor, ftype="fir")
+    _465A_data = scipy.signal.decimate(_465A_data, decimate_factor, ftype="fir")
+  return pd.DataFrame({
+    "utc_datetime" : pd.date_range(data.info.start_date, data.info.stop_date, periods=int(total_samples)),
+    "time_seconds" : np.arange(0, total_seconds, sampling_interval),
+    "_405" : _405A_data,
+    "_465" : _465A_data
+  })
+
+
+@pytest.mark.parametrize("decimate", [True, False])
+def test_get_tdt_data_matches_baseline(decimate):
+  session = make_session()
+  expected = baseline_get_tdt_data(session.data, decimate=decimate)
+  pd.testing.assert_frame_equal(get_tdt_data(session, decimate=decimate), expected)
+  pd.testing.assert_frame_equal(get_tdt_data(session, decimate=decimate, n_jobs=2), expected)
+
+def test_get_tdt_data_chunked_close_to_baseline():
+  session = make_session()
+  expected = baseline_get_tdt_data(session.data)
+  df = get_tdt_data(session, chunk_size=4096)
+  assert (df.dtypes == expected.dtypes).all()
+  pd.testing.assert_frame_equal(df, expected, check_exact=False, rtol=0, atol=1e-4)
+
+def test_remove_start_drops_the_laser_onset():
+  session = make_session()
+  df = get_tdt_data(session)
+  trimmed = get_tdt_data(session, remove_start=True)
+  # 5 seconds after the last laser onset, in decimated samples
+  remove_before = int(np.ceil((1.2 + 5) * FS / 10))
+  assert len(trimmed) == len(df) - remove_before
+  np.testing.assert_array_equal(trimmed._465.values, df._465.values[remove_before:])
+  assert trimmed.time_seconds.iloc[0] >= 1.2 + 5
+
+def test_session_warm_start_follows_n_remove():
+  data = get_photometry_data(make_session(seconds=120))
+  warm_start = {}
+  for n_remove in (500, 800, 300):
+    calculate_session_zdFF(data, n_remove=n_remove, align='fast', warm_start=warm_start)
+    assert set(warm_start) == {'reference', 'signal'}
+    for state in warm_start.values():
+      # the weights cover the smoothed channels, see smoothing.output_length
+      assert state.offset == n_remove and len(state.weights) == output_length(len(data) - n_remove, int(data.fs))
@@ -0,0 +1,47 @@
+'''
+test_instrumentation.py checks that stages and events cost nothing beyond a level check when disabled, run with:
+  python -m pytest -q
+'''
+
+import logging
+import pytest
+
+import instrumentation
+from instrumentation import event, stage, start_trace, stop_trace
+
+
+@pytest.fixture
+def log():
+  log = instrumentation.get_logger("test")
+  level = log.level
+  yield log
+  log.setLevel(level)
+
+def test_disabled_does_not_format(log, monkeypatch):
+  def format_fields(fields):
+    raise AssertionError("fields formatted with DEBUG off")
+  monkeypatch.setattr(instrumentation, "_format", format_fields)
+  log.setLevel(logging.INFO)
+  event("fit", log=log, n=10)
+  with stage("read", log=log, n=10):
+    pass
+
+def test_debug_logs_fields(log, caplog):
+  log.setLevel(logging.DEBUG)
+  with caplog.at_level(logging.DEBUG, logger=log.name):
+    event("fit", log=log, n=10, iterations=3)
+    with stage("read", log=log) as fields:
+      fields.update(bytes_read=5)
+  assert "fit n=10 iterations=3" in caplog.text
+  assert "bytes_read=5" in caplog.text
+
+def test_trace_collects_without_logging(log):
+  log.setLevel(logging.INFO)
+  start_trace()
+  try:
+    event("fit", log=log, n=10)
+    with stage("read", log=log, n=10):
+      pass
+  finally:
+    events = stop_trace()
+  assert [(e["name"], e["ph"], e["args"]["n"]) for e in events] == [("fit", "i", 10), ("read", "X", 10)]
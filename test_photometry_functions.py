@@ -0,0 +1,142 @@
+'''
+test_photometry_functions.py checks the fast processing kernels against direct reference implementations,
+run with:
+  python -m pytest -q
+'''
+
+import logging
+import numpy as np
+import pytest
+
+import photometry_functions
+from photometry_functions import (WhittakerSmooth, airPLS, airPLS_segmented, AirPLSState, airPLS_sweep,
+                                  compare_warm_start, fit_positive_slope, get_zdFF)
+from benchmark import synthetic_signal, reference_WhittakerSmooth
+
+# airPLS logs a warning when it does not converge, the reference does not
+logging.getLogger("tdt_photo_viewer").setLevel(logging.ERROR)
+
+
+def reference_airPLS(x, lambda_=100, porder=1, itermax=15):
+  # the original sparse airPLS, with porder as the order of the penalty
+  m = x.shape[0]
+  w = np.ones(m)
+  for i in range(1, itermax + 1):
+    z = reference_WhittakerSmooth(x, w, lambda_, porder)
+    d = x - z
+    dssn = np.abs(d[d < 0].sum())
+    if dssn < 0.001 * (abs(x)).sum() or i == itermax:
+      break
+    w[d >= 0] = 0
+    w[d < 0] = np.exp(i * np.abs(d[d < 0]) / dssn)
+    w[0] = np.exp(i * (d[d < 0]).max() / dssn)
+    w[-1] = w[0]
+  return z
+
+
+@pytest.mark.parametrize("differences", [1, 2])
+def test_whittaker_matches_sparse(differences):
+  x = synthetic_signal(5000)
+  w = np.random.default_rng(1).uniform(0, 2, len(x))
+  np.testing.assert_allclose(WhittakerSmooth(x, w, 5e4, differences), reference_WhittakerSmooth(x, w, 5e4, differences),
+                             rtol=1e-8, atol=1e-8)
+
+@pytest.mark.parametrize("lambd, itermax", [(1e2, 15), (5e4, 50)])
+def test_airPLS_matches_sparse(lambd, itermax):
+  x = synthetic_signal(5000) - 50
+  np.testing.assert_allclose(airPLS(x, lambd, 1, itermax), reference_airPLS(x, lambd, 1, itermax), rtol=1e-7, atol=1e-7)
+
+def test_airPLS_second_order_penalty():
+  # porder sets the order of the penalty, the original solver used first differences for any porder
+  x = synthetic_signal(5000) - 50
+  z = airPLS(x, 5e4, 2, 50)
+  np.testing.assert_allclose(z, reference_airPLS(x, 5e4, 2, 50), rtol=1e-7, atol=1e-7)
+  assert not np.allclose(z, airPLS(x, 5e4, 1, 50))
+
+def test_penalty_bands_released_after_get_zdFF():
+  x = synthetic_signal(5000)
+  get_zdFF(x, x + synthetic_signal(5000, seed=1), smooth_win=10, align='fast')
+  assert photometry_functions._shared_bands is None
+
+def test_airPLS_segmented_close_to_global():
+  x = synthetic_signal(50000)
+  z = airPLS(x, 5e4, 1, 50)
+  segmented = airPLS_segmented(x, 5e4, 1, 50, window=2**13)
+  assert np.abs(segmented - z).max() < 0.01 * x.std()
+
+@pytest.mark.parametrize("n_jobs", [4, None, -1])
+def test_airPLS_segmented_parallel(n_jobs):
+  x = synthetic_signal(50000)
+  np.testing.assert_array_equal(airPLS_segmented(x, 5e4, 1, 50, window=2**13, n_jobs=n_jobs),
+                                airPLS_segmented(x, 5e4, 1, 50, window=2**13))
+
+@pytest.mark.parametrize("true_slope", [0.8, -0.3])
+def test_fit_positive_slope_matches_lasso(true_slope):
+  from sklearn.linear_model import Lasso
+  rng = np.random.default_rng(1)
+  x = rng.standard_normal(10000)
+  y = true_slope * x + rng.standard_normal(10000)
+  lin = Lasso(alpha=0.0001, precompute=True, max_iter=1000, positive=True, random_state=9999, selection='random')
+  lin.fit(x.reshape(-1, 1), y.reshape(-1, 1))
+  slope, intercept = fit_positive_slope(x, y)
+  assert np.isclose(slope, lin.coef_[0], rtol=1e-6, atol=1e-9)
+  assert np.isclose(intercept, np.ravel(lin.intercept_)[0], rtol=1e-6, atol=1e-9)
+
+def test_get_zdFF_fast_align_matches_lasso():
+  x = synthetic_signal(20000)
+  y = x + synthetic_signal(20000, seed=1)
+  np.testing.assert_allclose(get_zdFF(x, y, align='fast'), get_zdFF(x, y), rtol=0, atol=1e-6)
+
+def test_airPLS_float32_input():
+  x = synthetic_signal(5000).astype(np.float32)
+  np.testing.assert_allclose(airPLS(x, 5e4, 1, 50), airPLS(x.astype(np.float64), 5e4, 1, 50), rtol=0, atol=1e-9)
+
+@pytest.mark.parametrize("dtype", ['float64', 'float32'])
+@pytest.mark.parametrize("smooth_win", [1, 2, 10])
+def test_get_zdFF_leaves_inputs_unchanged(dtype, smooth_win):
+  reference = synthetic_signal(5000).astype(dtype)
+  signal = synthetic_signal(5000, seed=1).astype(dtype)
+  reference.setflags(write=False)
+  signal.setflags(write=False)
+  expected = reference.copy(), signal.copy()
+  get_zdFF(reference, signal, smooth_win=smooth_win, align='fast', dtype=dtype)
+  np.testing.assert_array_equal(reference, expected[0])
+  np.testing.assert_array_equal(signal, expected[1])
+
+def test_get_zdFF_float32_close_to_float64():
+  reference = synthetic_signal(20000).astype(np.float32)
+  signal = synthetic_signal(20000, seed=1).astype(np.float32)
+  zdFF = get_zdFF(reference, signal, smooth_win=101, remove=1, align='fast')
+  zdFF32 = get_zdFF(reference, signal, smooth_win=101, remove=1, align='fast', dtype='float32')
+  assert zdFF32.dtype == np.float32
+  assert np.abs(zdFF32 - zdFF).max() < 1e-4
+
+def test_airPLS_warm_start_same_parameters():
+  # a converged state fitted again with the same parameters gives the same baseline at once
+  x = synthetic_signal(5000) - 50
+  state = AirPLSState()
+  z = airPLS(x, 5e4, 1, 50, state=state)
+  np.testing.assert_array_equal(airPLS(x, 5e4, 1, 50, state=state), z)
+  assert state.iterations == 1
+
+def test_get_zdFF_warm_start_matches_cold():
+  # weights are only reused with the same parameters, so zdFF is always the cold one
+  reference, signal = synthetic_signal(20000, seed=1), synthetic_signal(20000, seed=2)
+  warm_start = {}
+  for lambd, remove in ((1e4, 1), (1e4, 200), (1e5, 1), (1e4, 1)):
+    warm = get_zdFF(reference, signal, 101, remove, lambd, align='fast', warm_start=warm_start)
+    np.testing.assert_array_equal(warm, get_zdFF(reference, signal, 101, remove, lambd, align='fast'))
+    # the dict only holds the states of the two channels, with the parameters they were fitted with
+    assert set(warm_start) == {'reference', 'signal'}
+    assert all(isinstance(state, AirPLSState) and state.params == (101, lambd, 1, 50) for state in warm_start.values())
+
+def test_airPLS_sweep_warm_start():
+  x = synthetic_signal(20000)
+  x = x - np.median(x) + 0.5
+  lambdas = np.logspace(3, 6, 7)
+  cold, _ = airPLS_sweep(x, lambdas, 1, 50)
+  for k, lambd in enumerate(lambdas):
+    np.testing.assert_array_equal(cold[k], airPLS(x, lambd, 1, 50))
+  result = compare_warm_start(x, lambdas, 1, 50, n_jobs=2)
+  assert result['iterations_saved'] == result['cold_iterations'].sum() - result['warm_iterations'].sum()
+  assert result['iterations_saved'] > 0
@@ -0,0 +1,26 @@
+'''
+test_scrolling_trace.py checks the ring buffer of the live plot against slicing the session, run with:
+  python -m pytest -q
+'''
+
+import numpy as np
+
+from scrolling_trace import ScrollingTrace
+
+
+def test_update_matches_slicing():
+  rng = np.random.default_rng(0)
+  n, window = 20000, 500
+  x = np.arange(n) / 101.7
+  y = rng.standard_normal(n)
+  trace = ScrollingTrace(x, y, window)
+  assert trace.y_range() is None
+  # frame ticks of a few samples, jumps past the window, seeks back and the end of the session
+  stops = np.concatenate([np.cumsum(rng.integers(0, 7, 300)), [3000, 3499, 2000, 1, 0, 700, n + 10]])
+  for stop in stops:
+    tx, ty = trace.update(stop)
+    start = max(0, min(stop, n) - window)
+    np.testing.assert_array_equal(tx, x[start:stop])
+    np.testing.assert_array_equal(ty, y[start:stop])
+    if len(ty):
+      assert trace.y_range() == (ty.min(), ty.max())
@@ -0,0 +1,47 @@
+'''
+test_session_cache.py checks that SessionCache round-trips arrays and recovers from broken entries, run with:
+  python -m pytest -q
+'''
+
+import os
+import numpy as np
+import pytest
+
+from session_cache import SessionCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+  return SessionCache(cache_dir=str(tmp_path / "cache"))
+
+def put_entry(cache, key="entry"):
+  arrays = {"_405": np.arange(1000, dtype=np.float32), "zdFF": np.ones(1000, dtype=np.float32)}
+  cache.put(key, arrays)
+  return arrays
+
+def test_get_returns_the_arrays(cache):
+  arrays = put_entry(cache)
+  cached = cache.get("entry")
+  assert set(cached) == set(arrays)
+  np.testing.assert_array_equal(cached["_405"], arrays["_405"])
+
+def test_missing_key_is_a_miss(cache):
+  assert cache.get("missing") is None
+
+@pytest.mark.parametrize("damage", ["delete", "truncate", "meta"])
+def test_broken_entry_is_a_miss(cache, damage):
+  put_entry(cache)
+  entry = cache.path("entry")
+  if damage == "delete":
+    os.remove(os.path.join(entry, "zdFF.npy"))
+  elif damage == "truncate":
+    with open(os.path.join(entry, "zdFF.npy"), "r+b") as f:
+      f.truncate(200)
+  else:
+    with open(os.path.join(entry, "meta.json"), "w") as f:
+      f.write('{"arrays": ["_4')
+  assert cache.get("entry") is None
+  assert not os.path.exists(entry)
+  # the next put rewrites the entry
+  put_entry(cache)
+  assert cache.get("entry") is not None
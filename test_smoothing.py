@@ -0,0 +1,33 @@
+'''
+test_smoothing.py checks the O(n) kernels of smooth_signal against the direct convolution, run with:
+  python -m pytest -q
+'''
+
+import numpy as np
+import pytest
+
+from photometry_functions import smooth_signal
+from smoothing import output_length
+from benchmark import synthetic_signal, reference_smooth_signal
+
+
+@pytest.mark.parametrize("n", [50, 1001])
+@pytest.mark.parametrize("window_len", [3, 4, 10, 11, 49, 50])
+@pytest.mark.parametrize("window", ['flat', 'hanning', 'hamming', 'bartlett', 'blackman'])
+def test_smoothing_matches_convolution(n, window_len, window):
+  x = synthetic_signal(n)
+  expected = reference_smooth_signal(x, window_len, window)
+  out = np.empty(output_length(len(x), window_len))
+  np.testing.assert_allclose(smooth_signal(x, window_len, window, out=out), expected, rtol=0, atol=1e-9)
+  y32 = smooth_signal(x.astype(np.float32), window_len, window)
+  assert y32.dtype == np.float32
+  np.testing.assert_allclose(y32, expected, rtol=1e-5, atol=1e-3)
+
+@pytest.mark.parametrize("window_len", [1, 2])
+def test_short_windows_write_out(window_len):
+  x = synthetic_signal(100)
+  out = np.zeros(output_length(len(x), window_len))
+  assert smooth_signal(x, window_len, out=out) is out
+  np.testing.assert_array_equal(out, x)
+  with pytest.raises(ValueError):
+    smooth_signal(x, window_len, out=np.zeros(len(x) + 1))
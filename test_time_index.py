@@ -0,0 +1,21 @@
+'''
+test_time_index.py checks TimeIndex against the np.argmin lookups it replaces, run with:
+  python -m pytest -q
+'''
+
+import numpy as np
+import pytest
+
+from time_index import TimeIndex
+
+
+@pytest.mark.parametrize("jitter", [False, True])
+def test_nearest_matches_argmin(jitter):
+  n, fs = 100000, 101.7
+  rng = np.random.default_rng(2)
+  times = np.arange(n) / fs
+  if jitter:
+    times = np.sort(times + rng.uniform(0, 0.5 / fs, n))
+  queries = rng.uniform(-1, n / fs + 1, 1000)
+  expected = [np.argmin(np.abs(q - times)) for q in queries]
+  np.testing.assert_array_equal(TimeIndex(times).nearest(queries), expected)
@@ -0,0 +1,42 @@
+'''
+test_timebase.py checks Timebase against the materialized sample times, run with:
+  python -m pytest -q
+'''
+
+import datetime
+import numpy as np
+import pytest
+
+from timebase import Timebase
+
+# 24414.0625 / 24 Hz as TDT stores it (float32), the rate of the 405A/465A streams
+TDT_FS = float(np.float32(24414.0625 / 24))
+START = datetime.datetime(2022, 4, 15, 5, 20)
+
+
+@pytest.mark.parametrize("decimated", [True, False])
+def test_searchsorted_matches_numpy(decimated):
+  # 8 hours at the TDT rate, decimated by 10 as get_photometry_data does, or at 1 / sampling_interval
+  hours, q = 8, 10
+  n = int(hours * 3600 * TDT_FS / q)
+  timebase = Timebase(n, TDT_FS, q, start=START) if decimated else Timebase(n, 1 / (q / TDT_FS), start=START)
+  rng = np.random.default_rng(0)
+  seconds = timebase.seconds()
+  assert len(seconds) == n
+  assert np.abs(seconds - np.arange(n) * (q / TDT_FS)).max() < 1e-6
+  t = np.concatenate([rng.uniform(-1, hours * 3600 + 1, 10000), seconds[rng.integers(0, n, 100)]])
+  for side in ("left", "right"):
+    np.testing.assert_array_equal(timebase.searchsorted(t, side), np.searchsorted(seconds, t, side))
+  dates = timebase.datetimes()
+  t = np.datetime64(START, "ns") + (t * 1e9).astype("timedelta64[ns]")
+  np.testing.assert_array_equal(timebase.searchsorted(t), np.searchsorted(dates, t))
+  part = timebase[n // 3:n // 2]
+  t = rng.uniform(seconds[n // 3] - 1, seconds[n // 2] + 1, 10000)
+  np.testing.assert_array_equal(part.searchsorted(t), np.searchsorted(part.seconds(), t))
+
+def test_datetimes_close_to_date_range():
+  import pandas as pd
+  n, q = 100000, 10
+  expected = pd.date_range(START, periods=n, freq=pd.Timedelta(q / TDT_FS, "s")).values
+  # pd.date_range rounds the frequency to whole nanoseconds, the timebase keeps the exact period
+  assert np.abs(Timebase(n, TDT_FS, q, start=START).datetimes() - expected).max() <= np.timedelta64(n, "ns")
@@ -0,0 +1,61 @@
+'''
+time_index.py maps times in seconds to sample indices without scanning the whole recording.
+
+TimeIndex replaces np.argmin(np.abs(t - times)) lookups: uniformly sampled time vectors
+(e.g. the decimated photometry) use an analytic O(1) index and anything else
+(e.g. camera frame onsets) uses a binary search with np.searchsorted, O(log n).
+'''
+
+import numpy as np
+
+class TimeIndex:
+  '''
+  TimeIndex finds the sample closest to a given time in a sorted time vector
+  times: sorted 1D array of times in seconds
+  rtol: relative tolerance on the sampling interval to consider times uniform
+  '''
+  def __init__(self, times, rtol=1e-6):
+    self.times = np.asarray(times)
+    self.n = len(self.times)
+    self.t0 = self.times[0] if self.n else 0.0
+    self.dt = None
+    if self.n == 1:
+      self.dt = 1.0
+    elif self.n > 1:
+      steps = np.diff(self.times)
+      dt = (self.times[-1] - self.t0) / (self.n - 1)
+      if dt > 0 and np.all(np.abs(steps - dt) <= rtol * dt + np.finfo(float).eps * abs(self.times[-1])):
+        self.dt = dt
+
+  @property
+  def uniform(self):
+    return self.dt is not None
+
+  def __len__(self):
+    return self.n
+
+  def nearest(self, t):
+    '''
+    returns the index of the sample closest to t (scalar or array),
+    ties go to the earlier sample like np.argmin
+    '''
+    t = np.asarray(t, dtype=float)
+    if self.uniform:
+      idx = np.ceil((t - self.t0) / self.dt - 0.5)
+      idx = np.clip(idx, 0, self.n - 1).astype(np.intp)
+    else:
+      right = np.clip(np.searchsorted(self.times, t, side="left"), 1, self.n - 1)
+      left = right - 1
+      idx = np.where(t - self.times[left] <= self.times[right] - t, left, right)
+    return idx.item() if idx.ndim == 0 else idx
+
+  def window(self, start, stop):
+    '''
+    returns a slice with the samples with start <= times < stop
+    '''
+    if self.uniform:
+      first = int(np.clip(np.ceil((start - self.t0) / self.dt), 0, self.n))
+      last = int(np.clip(np.ceil((stop - self.t0) / self.dt), 0, self.n))
+    else:
+      first, last = np.searchsorted(self.times, [start, stop], side="left")
+    return slice(int(first), int(max(first, last)))
@@ -0,0 +1,117 @@
+'''
+timebase.py computes the time of each sample of a uniformly sampled stream on demand.
+
+Timebase replaces the pd.date_range and np.arange columns of the session: the time of sample
+k is start + k * period, with the period kept as an exact fraction of nanoseconds (TDT rates
+are 25 MHz * 2**k / decimation, so the period of a decimated stream is a simple fraction),
+so no sample time drifts however long the recording and every array has exactly n values.
+Slicing and searchsorted work on the arithmetic, only datetimes() and seconds() allocate.
+'''
+
+from fractions import Fraction
+import numpy as np
+
+# denominator limit used to turn a floating point rate into an exact fraction
+MAX_DENOMINATOR = 10**6
+
+class Timebase:
+  '''
+  Timebase holds the times of n samples taken every decimate_factor / fs seconds
+  n: number of samples, use the length of the data arrays it describes
+  fs: sampling rate in Hz before decimation
+  decimate_factor: decimation applied to the stream
+  start: datetime (or numpy.datetime64) of sample 0, None if unknown (only seconds are available)
+  offset: index of sample 0 in the full stream, set when slicing
+  '''
+  def __init__(self, n, fs, decimate_factor=1, start=None, offset=0):
+    self.n = int(n)
+    self.fs = fs
+    self.decimate_factor = decimate_factor
+    rate = Fraction(fs).limit_denominator(MAX_DENOMINATOR)
+    # period in nanoseconds as num / den
+    period = Fraction(decimate_factor * 10**9) / rate
+    self.num = period.numerator
+    self.den = period.denominator
+    self.start = start
+    self.start_ns = None if start is None else np.datetime64(start, "ns").astype(np.int64)
+    self.offset = int(offset)
+
+  def __len__(self):
+    return self.n
+
+  @property
+  def period(self):
+    # seconds between samples, as a float
+    return self.num / self.den / 1e9
+
+  def _ns(self, k):
+    # exact time of samples k in ns since sample 0 of the full stream, without int64 overflow
+    k = np.array(k, dtype=np.int64)
+    k += self.offset
+    q, r = divmod(self.num, self.den)
+    if r == 0:
+      # whole number of ns, the usual case for TDT rates
+      k *= q
+      return k
+    return k * q + (k * r) // self.den
+
+  def _check_index(self, index):
+    index = np.asarray(index, dtype=np.int64)
+    index = np.where(index < 0, index + self.n, index)
+    if np.any((index < 0) | (index >= self.n)):
+      raise IndexError("index out of range")
+    return index
+
+  def __getitem__(self, key):
+    '''
+    slices return a Timebase, integers and arrays return datetime64[ns] values
+    '''
+    if isinstance(key, slice):
+      start, stop, step = key.indices(self.n)
+      if step != 1:
+        raise ValueError("Timebase only supports contiguous slices")
+      return Timebase(max(stop - start, 0), self.fs, self.decimate_factor, self.start, self.offset + start)
+    return self.datetimes(self._check_index(key))
+
+  def seconds(self, index=None):
+    '''
+    time in seconds since the start of the stream of samples index (all of them by default)
+    '''
+    index = np.arange(self.n) if index is None else self._check_index(index)
+    return self._ns(index) / 1e9
+
+  def datetimes(self, index=None):
+    '''
+    datetime64[ns] of samples index (all of them by default)
+    '''
+    if self.start_ns is None:
+      raise ValueError("the timebase has no start date")
+    ns = self._ns(np.arange(self.n) if index is None else self._check_index(index))
+    ns += self.start_ns
+    return ns.view("datetime64[ns]")
+
+  def searchsorted(self, t, side="left"):
+    '''
+    like np.searchsorted(self.seconds(), t) (or self.datetimes() for datetime64 values of t),
+    computed from the period
+    '''
+    t = np.asarray(t)
+    if np.issubdtype(t.dtype, np.datetime64):
+      if self.start_ns is None:
+        raise ValueError("the timebase has no start date")
+      ns = t.astype("datetime64[ns]").astype(np.int64) - self.start_ns
+    else:
+      ns = np.round(t.astype(float) * 1e9).astype(np.int64)
+    # first guess from the period in floating point (ns * den overflows int64 for TDT rates),
+    # then correct it with the exact integer times
+    k = np.floor(ns * (self.den / self.num)).astype(np.int64) - self.offset
+    k = np.clip(k, 0, self.n)
+    for _ in range(2):
+      below = k > 0
+      before = self._ns(np.maximum(k - 1, 0))
+      move_down = below & ((before >= ns) if side == "left" else (before > ns))
+      k = np.where(move_down, k - 1, k)
+      at = self._ns(np.minimum(k, max(self.n - 1, 0)))
+      move_up = (k < self.n) & ((at < ns) if side == "left" else (at <= ns))
+      k = np.where(move_up, k + 1, k)
+    return k.item() if k.ndim == 0 else k